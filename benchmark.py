@@ -10,6 +10,24 @@ bare 0.136276006699
 
 pypy read 0.326532125473
 bare 0.0427839756012
+
+python hydrate 1000 x 50 field documents
+per key __setitem__ 0.782947063446
+_from_son 0.543117046356
+
+python attribute access x 100000, __getattribute__/__setattr__ overrides
+field get 0.0940840244293
+field set 0.387774944305
+internal get 0.242745161057
+
+python attribute access x 100000, field descriptors
+field get 0.0334138870239
+field set 0.161926031113
+internal get 0.00806403160095
+
+python serialize 10000 documents with one embedded job
+recursive walk 0.102540969849
+generated serializer 0.0429060459137
 """
 
 
@@ -83,3 +101,129 @@ for c in Human.find():
 	print "ORM: %s" % c.name
 orm_finish = time.time()-orm_get
 print orm_finish
+
+#hydration of a wide model, the old per key __setitem__ path against Document._from_son
+from bson.objectid import ObjectId
+from bson.son import SON
+
+Wide = type("Wide", (orm.Document,), dict([("_db", "test"), ("_collection", "wide")] + [("field%s" % i, field.Char()) for i in xrange(50)]))
+
+def legacy_setitem(self, key, val):
+	#what pymongo called once per key with as_class=cls before Document._from_son
+	if key != '_id':
+		try:
+			self.__hargs__[key] = val.__hargs__
+		except:
+			self.__hargs__[key] = val
+		self.__hargskeys__.add(key)
+		if self.__keys__.issubset(self.__hargskeys__) and self._id:
+			self._map(self.__hargs__, init=True)
+	elif key == '_id': self._id = val
+
+def legacy_hydrate(cls, son):
+	obj = cls()
+	obj.__hargs__ = {}
+	obj.__hargskeys__ = set()
+	for key, val in son.iteritems():
+		legacy_setitem(obj, key, val)
+	return obj
+
+sons = []
+for c in xrange(1000):
+	son = SON([("_id", ObjectId())])
+	son.update(("field%s" % i, "value %s" % i) for i in xrange(50))
+	sons.append(son)
+
+legacy_start = time.time()
+for son in sons:
+	legacy_hydrate(Wide, son)
+legacy_time = time.time()-legacy_start
+print "LEGACY HYDRATE: %s" % legacy_time
+
+son_start = time.time()
+for son in sons:
+	Wide._from_son(son)
+son_time = time.time()-son_start
+print "_from_son HYDRATE: %s" % son_time
+
+#attribute get/set throughput on a model
+human = Human()
+human.name = "Chris"
+
+get_start = time.time()
+for c in xrange(100000):
+	human.name
+get_time = time.time()-get_start
+print "FIELD GET: %s" % get_time
+
+set_start = time.time()
+for c in xrange(100000):
+	human.name = "Chris"
+set_time = time.time()-set_start
+print "FIELD SET: %s" % set_time
+
+internal_start = time.time()
+for c in xrange(100000):
+	human._parent
+	human.logger
+internal_time = time.time()-internal_start
+print "INTERNAL GET: %s" % internal_time
+
+#serializing 10k documents, the generated per model serializer against the recursive walk it replaced
+def legacy_json(obj):
+	ret = {}
+	for name, key, cls, a, kw in obj.__class__._schema():
+		try:
+			if not issubclass(cls, orm.Lazy):
+				v = obj._get(name)
+				if isinstance(v, orm.List): ret[key] = legacy_list_json(v)
+				elif isinstance(v, orm.base): ret[key] = legacy_json(v)
+				else: ret[key] = v._json()
+		except: pass
+	return ret
+
+def legacy_list_json(objs):
+	ret = []
+	for obj in objs:
+		try:
+			ret.append(legacy_json(obj) if isinstance(obj, orm.base) else obj._json())
+		except:
+			ret.append(obj)
+	return ret
+
+humans = []
+for c in xrange(10000):
+	human = Human()
+	human.name = "Chris"
+	human.age = 31
+	human.height = 120
+	human.weight = 180
+	human.genitalia = "outy"
+	job = Job()
+	job.title = "Engineer"
+	human.jobs.append(job)
+	humans.append(human)
+
+legacy_json_start = time.time()
+for human in humans:
+	legacy_json(human)
+legacy_json_time = time.time()-legacy_json_start
+print "LEGACY JSON: %s" % legacy_json_time
+
+json_start = time.time()
+for human in humans:
+	human._json()
+json_time = time.time()-json_start
+print "GENERATED JSON: %s" % json_time
+
+#inserts per second under each write concern
+for wc in ({"w":0}, {"w":1}, {"j":True}):
+	Human.__remove__()
+	wc_start = time.time()
+	for c in xrange(1000):
+		human = Human()
+		human.name = "Chris"
+		human.age = 31
+		human.save(write_concern=wc)
+	wc_time = time.time()-wc_start
+	print "INSERTS/SEC %s: %s" % (wc, 1000/wc_time)
@@ -18,10 +18,21 @@ Humongolus is a Persistence and Widget Framework for MongoDB written in Python
 
 import settings as _settings
 import datetime
+import time
+import copy
+import atexit
+import weakref
+import itertools
+import threading
+import collections
+import Queue
 import pymongo
+import pymongo.cursor
+import pymongo.errors
 from bson.objectid import ObjectId
 
 EMPTY = ("", " ", None, "None")
+WRITE_CONCERN = ("w", "wtimeout", "j", "fsync", "safe")
 
 def settings(logger, db_connection, db_name=None, autoinc_db_name="auto_increment"):
     """Set the logger and MongoDB Connection
@@ -46,6 +57,32 @@ def import_class(kls):
         m = getattr(m, comp)
     return m
 
+_write_hooks = []
+
+def on_write(hook):
+    """Register a function called after every write humongolus sends to mongo, hook(collection, ids).
+
+    collection is the full name of the collection written to, ids the _ids of the documents written
+    or None when a query was removed or updated. Writes of a :class: `~WriteBuffer` call it from it's thread.
+
+    :Parameters:
+        - `hook`: the function
+    """
+    _write_hooks.append(hook)
+    return hook
+
+def _written(coll, ids=None):
+    for hook in _write_hooks: hook(coll.full_name, ids)
+
+def _spec_ids(spec):
+    #the _ids a query matches, None unless it is by _id
+    if isinstance(spec, ObjectId): return [spec]
+    if not isinstance(spec, dict) or not '_id' in spec: return None
+    val = spec['_id']
+    if not isinstance(val, dict): return [val]
+    if val.keys() == ['$in']: return list(val['$in'])
+    return None
+
 class FieldValidator(object):
     """Base class for custom field validation. Should always be extended.
     """
@@ -74,6 +111,10 @@ class FieldException(Exception):
     """Exception for field validation errors.
     """
     pass
+class NotLoadedException(FieldException):
+    """Exception raised when reading a field that was left out of the projection a :class: `~Document` was loaded with.
+    """
+    pass
 class DocumentException(Exception):
     """Exception thrown when an error/errors are raised when saving a Document
     """
@@ -91,6 +132,11 @@ class DocumentException(Exception):
     def __str__(self):
         return str(self.errors)
 
+class ConflictException(Exception):
+    """Exception raised when saving a _versioned :class: `~Document` that was changed in mongo since it was loaded.
+    """
+    pass
+
 class Attributes(object):
     _id = None
     _name = None
@@ -224,6 +270,9 @@ class Field(object):
     _base = None
     _parent = None
     _validate = None
+    _unchecked = False
+    _op = None
+    _insert_only = False
     __kwargs__ = {}
     __args__ = ()
 
@@ -242,13 +291,17 @@ class Field(object):
         self._value = self.clean(self._default, doc=None) if self._default else None
         self._error = None
 
-    def _clean(self, val, dirty=None, doc=None):
+    def _clean(self, val, dirty=None, doc=None, init=False):
         self._error = None
+        self._unchecked = False
+        if not init and self._parent is not None: self._parent._touch(self._name)
         self._isrequired(val)
         val = self.clean(val, doc=doc)
         val = self._validate(self).validate(val, doc=doc) if self._validate else val
-        self._dirty = self._value if not dirty else dirty
+        #while an atomic op is pending _dirty is the stored value, an assignment replacing the op is always saved
+        if dirty or self._op is None: self._dirty = self._value if not dirty else dirty
         self._value = val
+        self._op = None
 
     def clean(self, val, doc=None):
         """Override to apply custom parsing of incoming value.
@@ -269,21 +322,37 @@ class Field(object):
 
     def _save(self, namespace):
         obj = {}
-        if self._value != self._dirty: obj[namespace] = self._value
+        if self._op is not None: obj[namespace] = self._op
+        elif self._value != self._dirty: obj[namespace] = self._value
         return obj
 
+    def _reset(self):
+        self._dirty = self._value
+        self._op = None
+
     def _errors(self, namespace):
         errors = {}
         try:
+            if self._unchecked: self._check()
             self._isrequired(self._value)
         except Exception as e:
             self._error = e
         if self._error: errors[namespace] = self._error
         return errors
 
-    def _map(self, val, init=False, doc=None):
+    def _check(self):
+        #deferred validation of a value assigned by a trusted load
+        self._unchecked = False
+        val = self.clean(self._value, doc=None)
+        if self._validate: self._validate(self).validate(val, doc=None)
+
+    def _map(self, val, init=False, doc=None, trusted=False):
+        if init and trusted:
+            self._value = self._dirty = val
+            self._unchecked = True
+            return
         try:
-            if init: self._clean(val, dirty=val, doc=doc)
+            if init: self._clean(val, dirty=val, doc=doc, init=True)
             else: self._clean(val, doc=doc)
         except Exception as e:
             self._error = e
@@ -293,6 +362,24 @@ class Field(object):
     def _get_value(self):
         return self._value
 
+    def __get__(self, obj, cls):
+        if obj is None: return self
+        try:
+            fi = obj.__dict__[self._name]
+        except KeyError:
+            fi = obj._get(self._name)
+        return fi._get_value()
+
+    def __set__(self, obj, val):
+        try:
+            fi = obj.__dict__[self._name]
+        except KeyError:
+            fi = obj._get(self._name, fetch=False)
+        try:
+            fi._clean(val)
+        except FieldException as e:
+            fi._error = e
+
     def __repr__(self):
         try:
             return self._value
@@ -305,13 +392,65 @@ class Field(object):
     def __unicode__(self):
         return unicode(self._value)
 
-class Lazy(object):
-    """Object for describing a "foreign key" relationship across Models"""
+class Modifier(object):
+    """An update operator in the flat dict returned by _save, sent as {op:{path:value}} instead of $set"""
+    __slots__ = ("op", "value")
+
+    def __init__(self, op, value):
+        self.op = op
+        self.value = value
+
+    def __repr__(self):
+        return "Modifier(%r, %r)" % (self.op, self.value)
+
+def _json_value(val):
+    try:
+        return val._json()
+    except AttributeError:
+        return val
+
+class Descriptor(object):
+    """Exposes a :class: `~Lazy`, :class: `~List` or embedded document declared on a Model as a data descriptor.
+    The instance built for the Model is returned, assigning replaces it.
+    """
+
+    def __get__(self, obj, cls):
+        if obj is None: return self
+        try:
+            return obj.__dict__[self._name]
+        except KeyError:
+            return obj._get(self._name)
+
+    def __set__(self, obj, val):
+        if isinstance(val, (base, List)):
+            val._parent = obj
+            val._name = self._name
+        obj.__dict__[self._name] = val
+        obj._touch(self._name)
+
+def _son_values(son, key):
+    #the values of a dotted key in a raw document, arrays on the way are flattened
+    vals = [son]
+    for part in key.split("."):
+        found = []
+        for val in vals:
+            val = val.get(part, None) if isinstance(val, dict) else None
+            if isinstance(val, list): found.extend(val)
+            elif val is not None: found.append(val)
+        vals = found
+    return vals
+
+class Lazy(Descriptor):
+    """Object for describing a "foreign key" relationship across Models
+
+    Human.cars.prefetch(humans) loads the relation of many documents with one query, see :meth: `~Lazy.prefetch`.
+    """
     __kwargs__ = {}
     __args__ = ()
     _type = None
     _key = None
     _query = {}
+    _results = None
     _base = None
     _parent = None
     _name = None
@@ -323,7 +462,8 @@ class Lazy(object):
         """
         :Parameters:
             - `type`: the type of :class: `~Document` returned. must be an instance of :class: `~Document`
-            - `key`: the "foreign key" to look up the types by. must be an attribute of type.
+            - `key`: the "foreign key" to look up the types by. must be an attribute of type, dotted to reach into embedded documents
+            - `query`: added to every query of the relation
 
         """
         self.logger = _settings.LOGGER
@@ -339,14 +479,62 @@ class Lazy(object):
         """when calling the lazy object it will return a mongodb cursor that yields models of the type.
         It will use the the _id of the base document and look in the key of the type class
         """
-        q = kwargs.get('query', {})
-        q.update({self._key:self._base._id})
-        return self._type.find(q)
+        return self._type.find(self._filter(kwargs.get('query', None)))
+
+    def _filter(self, query=None):
+        q = dict(self._query)
+        if query: q.update(query)
+        q[self._key] = self._base._id
+        return q
+
+    def all(self, refresh=False):
+        """the models of the relation as a list, queried once and kept on the document or loaded by prefetch
+
+        :Parameters:
+            - `refresh`: query them again
+        """
+        if self._results is None or refresh: self._results = list(self())
+        return self._results
+
+    def count(self):
+        """number of models in the relation, counted by mongo unless they were loaded"""
+        if self._results is not None: return len(self._results)
+        return self._type._connection().find(self._filter()).count()
+
+    def exists(self):
+        """is there any model in the relation, without loading them"""
+        if self._results is not None: return len(self._results) > 0
+        return self._type._connection().find_one(self._filter(), fields={'_id':True}) is not None
+
+    def prefetch(self, parents):
+        """load the relation of every parent with a single $in query, all() then returns each parent's models.
+
+        Human.cars.prefetch(humans)
+
+        :Parameters:
+            - `parents`: documents the relation is declared on
+        """
+        self._fill([p._get(self._name) for p in parents])
+
+    def _fill(self, lazies):
+        #the models found are grouped back by the values of key, a model can belong to many parents
+        lazies = [l for l in lazies if l._base is not None and l._base._id is not None]
+        if not lazies: return
+        groups = dict((l._base._id, []) for l in lazies)
+        q = dict(self._query)
+        q[self._key] = {"$in":groups.keys()}
+        for son in self._type.find(q).iter_raw():
+            obj = self._type._from_son(son)
+            for val in _son_values(son, self._key):
+                group = groups.get(val, None)
+                if group is not None and not (group and group[-1] is obj): group.append(obj)
+        for l in lazies: l._results = groups[l._base._id]
 
     def _save(self, *args, **kwargs): pass
     def _errors(self, *args, **kwargs): pass
     def _map(self, *args, **kwargs): pass
     def _json(self, *args, **kwargs): pass
+    def _reset(self, *args, **kwargs): pass
 
     def render(self, *args, **kwargs): pass
 
@@ -359,7 +547,7 @@ class Lazy(object):
     def __unicode__(self):
         return unicode(self.__class__.__name__)
 
-class List(list):
+class List(Descriptor, list):
     """Used to describe an array in a :class: `~Document` or :class: `~EmbeddedDocument`. Extends list."""
     logger = None
     _type = None
@@ -369,6 +557,8 @@ class List(list):
     _parent = None
     _name = None
     _render = None
+    _stored = None
+    _added = ()
     __kwargs__ = {}
     __args__ = ()
 
@@ -391,28 +581,108 @@ class List(list):
 
 
     def append(self, obj):
+        self._append(obj)
+        self._touch()
+
+    def _append(self, obj):
         types = self._type if self._type is list else [self._type]
         if self._length and len(self) >= self._length: raise Exception("max length: %s exceeded" % self._length)
         if obj.__class__ in types:
+            if isinstance(obj, base): obj._parent = self
             super(List, self).append(obj)
         else: raise Exception("%s not of type %s" % (obj.__class__.__name__, self._type.__name__))
 
-    def _save(self, namespace):
-        # Delete all before beginning
-        conn = self._parent._coll
-        conn.update({'_id': self._parent._id}, {'$unset': {namespace: 1}}, upsert=False, safe=True)
-        conn.update({'_id': self._parent._id}, {'$set': {namespace: []}}, upsert=False, safe=True)
+    def extend(self, objs):
+        for obj in objs: self.append(obj)
 
-        ret = {}
-        for id, obj in enumerate(self):
-            ns = ".".join([namespace, str(id)])
+    def push(self, *objs):
+        """append objs, saved with $push"""
+        self.extend(objs)
+
+    def add_to_set(self, *objs):
+        """append the objs not already in the list, saved with $addToSet"""
+        for obj in objs:
+            if any(_same(o, obj) for o in self): continue
+            self._append(obj)
+            self._added = list(self._added) + [obj]
+        self._touch()
+
+    def insert(self, index, obj):
+        super(List, self).insert(index, obj)
+        self._touch()
+
+    def remove(self, obj):
+        super(List, self).remove(obj)
+        self._touch()
+
+    def pop(self, *args):
+        obj = super(List, self).pop(*args)
+        self._touch()
+        return obj
+
+    def sort(self, *args, **kwargs):
+        super(List, self).sort(*args, **kwargs)
+        self._touch()
+
+    def reverse(self):
+        super(List, self).reverse()
+        self._touch()
+
+    def __setitem__(self, index, obj):
+        super(List, self).__setitem__(index, obj)
+        self._touch()
+
+    def __delitem__(self, index):
+        super(List, self).__delitem__(index)
+        self._touch()
+
+    def __setslice__(self, i, j, objs):
+        super(List, self).__setslice__(i, j, objs)
+        self._touch()
+
+    def __delslice__(self, i, j):
+        super(List, self).__delslice__(i, j)
+        self._touch()
+
+    def __iadd__(self, objs):
+        self.extend(objs)
+        return self
+
+    def _touch(self, name=None):
+        #the list or one of it's documents changed, the whole list is saved
+        if self._parent is not None: self._parent._touch(self._name)
+
+    def _reset(self):
+        for obj in self:
             try:
-                if obj._inited: ret.update(obj._save(namespace=ns))
-                else: ret.update({ns:obj._json()})
-            except Exception as e:
-                ret[ns] = obj
+                obj._reset()
+            except AttributeError: pass
+        self._stored = list(self)
+        self._added = ()
 
-        return ret
+    def _save(self, namespace):
+        #diffs the list against what is stored in mongo, _stored is None if that is unknown
+        old = self._stored
+        if old is None: return {namespace:self._json()}
+        n = len(old)
+        if len(self) >= n and all(_same(a, b) for a, b in zip(old, self)):
+            changed = [i for i, obj in enumerate(old) if isinstance(obj, base) and obj._changed()]
+            if len(self) > n:
+                #appended only, an edit to a stored element would conflict with the $push
+                if changed: return {namespace:self._json()}
+                new = self[n:]
+                each = {"$each":[_json_value(o) for o in new]}
+                if not self._added: return {namespace:Modifier("$push", each)}
+                if len(new) == len(self._added) and all(_same(a, b) for a, b in zip(new, self._added)):
+                    return {namespace:Modifier("$addToSet", each)}
+                return {namespace:self._json()}
+            ret = {}
+            for i in changed: ret.update(old[i]._save(namespace=".".join([namespace, str(i)])))
+            return ret
+        removed = _removed(old, self)
+        if removed and not any(isinstance(o, base) for o in old) and not any(o in self for o in removed):
+            return {namespace:Modifier("$pull", {"$in":removed})}
+        return {namespace:self._json()}
 
     def _errors(self, namespace):
         errors = {}
@@ -424,17 +694,18 @@ class List(list):
         return errors
 
 
-    def _map(self, val, init=False, doc=None):
+    def _map(self, val, init=False, doc=None, trusted=False):
         for item in val:
             try:
                 obj = self._type()
                 if type(val) == list:
-                    obj._map(item, init=init, doc=None)
+                    obj._map(item, init=init, doc=None, trusted=trusted)
                 elif type(val) == dict:
-                    obj._map(val[item], init=init, doc=None)
-                self.append(obj)
+                    obj._map(val[item], init=init, doc=None, trusted=trusted)
+                self._append(obj)
             except:
-                self.append(item)
+                self._append(item)
+        if init: self._stored = list(self)
 
     def _json(self):
         ret = []
@@ -460,8 +731,132 @@ class List(list):
     def __unicode__(self):
         return unicode(self.__class__.__name__)
 
-class base(dict):
+def _same(a, b):
+    #documents are compared by identity, they compare equal as dicts
+    return a is b or (not isinstance(a, base) and not isinstance(b, base) and a == b)
+
+def _removed(old, new):
+    #the elements of old missing from new, None if new is not old with elements removed
+    removed = []
+    i = 0
+    for obj in old:
+        if i < len(new) and _same(obj, new[i]): i += 1
+        else: removed.append(obj)
+    return removed if i == len(new) else None
+
+class Schema(type):
+    """Metaclass for :class: `~base`. Compiles the declared fields of a model once per class
+    instead of reflecting over the class hierarchy every time a model is instantiated.
+
+    The compiled schema is invalidated whenever a field is assigned to the class after creation, ie; Human.cars = Lazy(...)
+
+    Fields are data descriptors named after the attribute they are assigned to, when the class is created or the field
+    assigned, so they work before the schema is compiled.
+    """
+
+    def __init__(cls, name, bases, d):
+        super(Schema, cls).__init__(name, bases, d)
+        for k, v in d.iteritems():
+            #base, List and Lazy are the Descriptors, base is being created itself
+            if isinstance(v, (Descriptor, Field)): v._name = k
+
+    def __setattr__(cls, key, val):
+        type.__setattr__(cls, key, val)
+        if isinstance(val, (base, Field, List, Lazy)):
+            val._name = key
+            cls._invalidate()
+        elif key in ("_db", "_collection"): cls._uncache()
+
+    def __delattr__(cls, key):
+        type.__delattr__(cls, key)
+        cls._invalidate()
+
+    __compiled__ = ("__schema__", "__index__", "__keys__", "__required__", "__json__")
+
+    def _uncache(cls):
+        #subclasses inherit _db and _collection, their cached collection goes too
+        if "__coll__" in cls.__dict__: type.__delattr__(cls, "__coll__")
+        for sub in cls.__subclasses__(): sub._uncache()
+
+    def _invalidate(cls):
+        for k in Schema.__compiled__:
+            if k in cls.__dict__: type.__delattr__(cls, k)
+        for sub in cls.__subclasses__(): sub._invalidate()
+
+    def _compile(cls):
+        fields = {}
+        order = []
+        for klass in reversed(cls.__mro__):
+            for k in sorted(klass.__dict__.keys()):
+                v = klass.__dict__[k]
+                if isinstance(v, (base, Field, List, Lazy)):
+                    if not k in fields: order.append(k)
+                    fields[k] = v
+        schema = []
+        keys = set()
+        required = set()
+        for k in order:
+            v = fields[k]
+            v._name = k
+            key = v._dbkey if v._dbkey else k
+            if not isinstance(v, Lazy): keys.add(unicode(key))
+            if isinstance(v, Field) and v._required: required.add(k)
+            elif isinstance(v, base) and v.__class__._compiled("__required__"): required.add(k)
+            kwargs = dict(v.__kwargs__)
+            for i in ("base", "name", "parent"): kwargs.pop(i, None)
+            schema.append((k, key, v.__class__, v.__args__, kwargs))
+        type.__setattr__(cls, "__schema__", tuple(schema))
+        type.__setattr__(cls, "__index__", dict((i[0], i) for i in schema))
+        type.__setattr__(cls, "__keys__", frozenset(keys))
+        type.__setattr__(cls, "__required__", frozenset(required))
+        type.__setattr__(cls, "__json__", cls._compile_json(schema))
+
+    def _compile_json(cls, schema):
+        """generates the serializer used by base._json, with dbkeys, embedded documents and lists unrolled"""
+        ns = {"List":List, "_json_value":_json_value}
+        lines = ["def _json(doc):", "    d = doc.__dict__", "    loaded = d['__loaded__']", "    obj = {}"]
+        for name, key, klass, a, kw in schema:
+            if issubclass(klass, Lazy): continue
+            #fields left out of a projection are left out of the json
+            lines.append("    if %r in d or loaded is None or %r in loaded:" % (name, name))
+            lines.append("        v = d[%r] if %r in d else doc._get(%r)" % (name, name, name))
+            if issubclass(klass, Field):
+                if klass._json.im_func is Field._json.im_func: lines.append("        obj[%r] = v._value" % key)
+                else: lines.append("        obj[%r] = v._json()" % key)
+            elif issubclass(klass, List):
+                t = kw.get("type", None)
+                item = "o._json()" if isinstance(t, type) and issubclass(t, base) else "_json_value(o)"
+                lines.append("        obj[%r] = [%s for o in v] if isinstance(v, List) else _json_value(v)" % (key, item))
+            else:
+                lines.append("        obj[%r] = _json_value(v)" % key)
+        lines.append("    return obj")
+        exec "\n".join(lines) in ns
+        return ns["_json"]
+
+    def _compiled(cls, key):
+        try:
+            return cls.__dict__[key]
+        except KeyError:
+            cls._compile()
+            return cls.__dict__[key]
+
+    def _schema(cls):
+        """ordered tuple of (name, dbkey, class, args, kwargs) for every field declared on the model or its bases"""
+        return cls._compiled("__schema__")
+
+    def _index(cls):
+        """schema entries keyed by attribute name"""
+        return cls._compiled("__index__")
+
+class base(Descriptor, dict):
+    """Base class for :class: `~Document` and :class: `~EmbeddedDocument`.
+
+    Set _lazy = True on a model to defer building its fields until they are first read, written, saved or serialized.
+    Values mapped from mongo are held raw until then.
+    """
+    __metaclass__ = Schema
     logger = None
+    _lazy = False
     _inited = False
     _base = None
     _parent = None
@@ -469,7 +864,7 @@ class base(dict):
     _dbkey = None
     __kwargs__ = {}
     __args__ = ()
-    __keys__ = []
+    __keys__ = frozenset()
     __doc__ = {}
 
 
@@ -479,90 +874,135 @@ class base(dict):
         self.__args__ = args
         self._inited = False
         b = kwargs.get("base", None)
-        self._base = b if b != self else None
-        self.__keys__ = set()
-        for cls in reversed(self.__class__._getbases()):
-            for k,v in cls.__dict__.iteritems():
-                if isinstance(v, (base, Field, List, Lazy)):
-                    key = v._dbkey if v._dbkey else k
-                    if not isinstance(v, Lazy): self.__keys__.add(unicode(key))
-                    v.__kwargs__["base"] = b
-                    v.__kwargs__['name'] = k
-                    v.__kwargs__['parent'] = self
-                    self.__dict__[k] = v.__class__(*v.__args__, **v.__kwargs__)
-
-    def __setattr__(self, key, val):
+        self._base = b if b is not self else None
+        self._parent = kwargs.get("parent", None)
+        self._name = kwargs.get("name", None)
+        d = self.__dict__
+        d["__raw__"] = {}
+        d["__trusted__"] = False
+        d["__dirty__"] = None
+        d["__unchecked__"] = set()
+        loaded = d.setdefault("__loaded__", None)
+        if self._lazy: return
+        for name, key, cls, a, kw in self.__class__._schema():
+            if loaded is not None and not name in loaded: continue
+            kw = dict(kw, base=b, name=name, parent=self)
+            d[name] = cls(*a, **kw)
+
+    def _get(self, key, fetch=True):
+        d = self.__dict__
         try:
-            fi = self.__dict__.get(key, None)
-            fi._clean(val)
-        except FieldException as e:
-            fi._error = e
-        except Exception as e:
-            self.__dict__[key] = val
-
-    def __getattribute__(self, key):
+            return d[key]
+        except KeyError: pass
         try:
-            obj = object.__getattribute__(self, key)
-            if isinstance(obj, Field): return obj._get_value()
-            else: return obj
-        except Exception as e: raise e
+            name, dbkey, cls, a, kw = self.__class__._index()[key]
+        except KeyError:
+            raise AttributeError("%s is an invalid attribute" % key)
+        loaded = d["__loaded__"]
+        unloaded = loaded is not None and not name in loaded and not issubclass(cls, Lazy)
+        if fetch and unloaded:
+            self._fetch(name)
+            if name in d: return d[name]
+        kw = dict(kw, base=self.__kwargs__.get("base", None), name=name, parent=self)
+        obj = d[name] = cls(*a, **kw)
+        raw = d["__raw__"]
+        if name in raw: obj._map(raw.pop(name), init=True, trusted=d["__trusted__"])
+        #a list outside the projection, appended to without reading it
+        elif unloaded and isinstance(obj, List): obj._stored = []
+        return obj
 
-    @classmethod
-    def _getbases(cls):
-        b = [cls]
-        for i in cls.__bases__:
-            b.append(i)
-            try:
-                b.extend(i._getbases())
-            except:pass
-        return b
 
-    def _get(self, key):
-        try:
-            return self.__dict__[key]
-        except:
-            raise AttributeError("%s is an invalid attribute")
+    def _touch(self, name):
+        """register name as changed, and this document as changed on it's parent"""
+        dirty = self.__dict__["__dirty__"]
+        if dirty is not None:
+            if name in dirty: return
+            dirty.add(name)
+        if self._parent is not None: self._parent._touch(self._name)
 
+    def _changed(self):
+        #schema entries that need to be saved, everything if the document was never loaded or saved
+        dirty = self.__dict__["__dirty__"]
+        if dirty is None: return self.__class__._schema()
+        index = self.__class__._index()
+        return [index[name] for name in dirty]
 
     def _save(self, namespace=None):
         obj = {}
-        for k,v in self.__dict__.iteritems():
+        for name, key, cls, a, kw in self._changed():
             try:
-                key = v._dbkey if v._dbkey else k
                 ns = ".".join([namespace, key]) if namespace else key
-                obj.update(v._save(namespace=ns))
+                obj.update(self._get(name)._save(namespace=ns))
             except Exception as e: pass
         return obj
 
+    def _reset(self):
+        d = self.__dict__
+        for name, key, cls, a, kw in self._changed():
+            if name in d:
+                try:
+                    d[name]._reset()
+                except AttributeError: pass
+        d["__dirty__"] = set()
+        d["__unchecked__"] = set()
+
     def _errors(self, namespace=None):
         errors = {}
-        for k,v in self.__dict__.iteritems():
+        d = self.__dict__
+        dirty = d["__dirty__"]
+        if dirty is None: entries = self.__class__._schema()
+        else:
+            #changed fields, fields loaded without validation and required fields that were never set
+            index = self.__class__._index()
+            required = self.__class__._compiled("__required__") - set(d["__raw__"])
+            if d["__loaded__"] is not None: required = required & d["__loaded__"]
+            names = dirty | d["__unchecked__"] | required
+            entries = [index[name] for name in names]
+        for name, key, cls, a, kw in entries:
             try:
-                key = v._dbkey if v._dbkey else k
                 ns = ".".join([namespace, key]) if namespace else key
-                errors.update(v._errors(namespace=ns))
+                errors.update(self._get(name)._errors(namespace=ns))
             except Exception as e: pass
         return errors
 
-    def _map(self, vals, init=False, doc=None):
+    def _map(self, vals, init=False, doc=None, trusted=False):
         self._inited = True
-        for k,v in self.__dict__.iteritems():
+        d = self.__dict__
+        raw = d["__raw__"] if init and self._lazy else None
+        if raw is not None: d["__trusted__"] = trusted
+        unchecked = d["__unchecked__"] if init and trusted else None
+        #values of fields outside the projection are partial, they are never mapped
+        loaded = d["__loaded__"] if init else None
+        for name, key, cls, a, kw in self.__class__._schema():
+            if loaded is not None and not name in loaded: continue
             try:
-                key = v._dbkey if v._dbkey else k
                 val = vals[key]
-                v._map(val, init=init, doc=doc)
+                if unchecked is not None: unchecked.add(name)
+                if raw is not None and not name in d: raw[name] = val
+                else: self._get(name)._map(val, init=init, doc=doc, trusted=trusted)
             except: pass
+        #loaded from mongo, nothing to save until something changes
+        if init: d["__dirty__"] = set()
 
     def _json(self):
-        obj = {}
-        for k,v in self.__dict__.iteritems():
-            try:
-                if not isinstance(v, Lazy):
-                    key = v._dbkey if v._dbkey else k
-                    obj[key] = v._json()
-            except: pass
+        return self.__class__._compiled("__json__")(self)
 
-        return obj
+    def inc(self, name, n=1):
+        """increment a Integer or Float field by n, saved with $inc
+
+        :Parameters:
+            - `name`: the field name
+            - `n`: amount to add
+        """
+        self._get(name, fetch=False).inc(n)
+
+    def push(self, name, *objs):
+        """append to a List field, saved with $push"""
+        self._get(name, fetch=False).push(*objs)
+
+    def add_to_set(self, name, *objs):
+        """append to a List field the objs it does not contain already, saved with $addToSet"""
+        self._get(name, fetch=False).add_to_set(*objs)
 
     def render(self): pass
 
@@ -589,6 +1029,31 @@ class Document(base):
 
     _indexes is used to set the mongo indexes, it should be an array of :class: `~Index` objects
 
+    _trusted = True loads documents from mongo without running clean() on the stored values,
+    validation is deferred until a field is modified or the document is saved. can also be passed per query, find(trusted=True)
+
+    _cascade = False turns off saving the documents dereferenced through DynamicDocument and DocumentReference fields
+    when the Model is saved, also per call with save(cascade=False).
+
+    _buffer = WriteBuffer(...) makes save() of new documents return as soon as they are queued, the inserts are written
+    in batches by a background thread. for append only Models, see :class: `~WriteBuffer`.
+
+    _write_concern is the pymongo write concern used for every write of the Model, {"w":1} by default.
+    {"w":0} for unacknowledged writes, {"j":True} to wait for the journal. save(write_concern=...) overrides it per call.
+
+    Documents loaded with a projection, find(fields=[...]) or Document(id=..., fields=[...]), only map the projected fields.
+    Reading a field outside the projection raises a NotLoadedException, set _fetch_missing = True to fetch the missing fields
+    from mongo on first access instead. Fields outside the projection are never saved unless assigned. a dotted key,
+    fields=["jobs.title"], only reads part of a field, the field is not loaded.
+
+    inside an :class: `~IdentityMap` every query, Document(id=...) and dereference of the same _id returns the same instance.
+
+    _cache = LRUCache(...) reads documents looked up by _id through a :class: `~Cache`, see :class: `~LRUCache`.
+
+    _versioned = True keeps a __version__ counter on the document, incremented by every save. an update only matches
+    the version that was loaded and raises a ConflictException if the document was saved by someone else in between,
+    without reading it first. conflicts are only detected with an acknowledged write concern.
+
     """
     _id = None
     _db = _settings.DB_NAME
@@ -596,43 +1061,142 @@ class Document(base):
     _conn = None
     _coll = None
     _indexes = []
+    _trusted = False
+    _fetch_missing = False
+    _write_concern = {"w":1}
+    _cascade = True
+    _buffer = None
+    _cache = None
+    _versioned = False
+    __version__ = None
     __modified__ = None
     __created__ = None
     __active__ = True
-    __hargs__ = {}
-    __hargskeys__ = None
+
+    def __new__(cls, *args, **kwargs):
+        if kwargs.get('id', None):
+            obj = cls._mapped(ObjectId(kwargs['id']), kwargs.get('fields', None))
+            if obj is not None: return obj
+        return super(Document, cls).__new__(cls, *args, **kwargs)
 
     def __init__(self, *args, **kwargs):
+        #an instance returned from the IdentityMap by __new__ is already loaded
+        if kwargs.get('id', None) and self._id is not None: return
         kwargs['base'] = self
+        fields = kwargs.get('fields', None)
+        self.__dict__["__loaded__"] = self.__class__._loaded(fields)
         super(Document, self).__init__(*args, **kwargs)
         self._id = None
-        self.__hargs__ = {}
-        self.__hargskeys__ = set()
         self._conn = _settings.DB_CONNECTION
-        self._coll = self._conn[self._db][self._collection]
+        self._coll = self.__class__._connection()
         if kwargs.get('id', None):
             self._id = ObjectId(kwargs['id'])
-            self._doc()
-    """
-    this is called by pymongo for each key:val pair for each document
-    returned by find and find_one
-    """
-    def __setitem__(self, key, val):
-        #_id is a built-in field, it won't be in self.__keys__
-        if key != '_id':
-            try:
-                self.__hargs__[key] = val.__hargs__
-            except:
-                self.__hargs__[key] = val
-            self.__hargskeys__.add(key)
-            #an incomplete document from mongo will never call _map
-            if self.__keys__.issubset(self.__hargskeys__) and self._id:
-                self._map(self.__hargs__, init=True)
-        elif key == '_id': self._id = val
+            self._doc(trusted=kwargs.get('trusted', None), fields=fields)
+
+    @classmethod
+    def _from_son(cls, son, trusted=None, fields=None):
+        """build a model from a raw document returned by pymongo
 
-    def _doc(self):
-        doc = self._coll.find_one({'_id':self._id})
-        self._map(doc, init=True)
+        :Parameters:
+            - `son`: the raw document
+            - `trusted`: assign the stored values without running clean(), defaults to the Model's _trusted
+            - `fields`: the projection the document was queried with, only those fields are considered loaded
+        """
+        obj = cls._mapped(son.get('_id', None), fields)
+        if obj is not None: return obj
+        obj = cls(fields=fields) if fields is not None else cls()
+        obj._load(son, trusted=trusted)
+        return obj
+
+    @classmethod
+    def _loaded(cls, fields):
+        """names of the fields a projection loads, None if it loads the whole document
+
+        :Parameters:
+            - `fields`: a pymongo projection, list of keys or dict of key:bool
+        """
+        if fields is None: return None
+        schema = cls._schema()
+        names = dict((key, name) for name, key, c, a, kw in schema)
+        #Lazy fields are not stored on the document, a projection never leaves them out
+        loaded = set(name for name, key, c, a, kw in schema if issubclass(c, Lazy))
+        if isinstance(fields, dict):
+            include = [k for k, v in fields.iteritems() if v and not isinstance(v, dict) and k != "_id"]
+            if not include:
+                #exclusion projection, a field is only loaded if nothing inside it was left out
+                excluded = set(names.get(k.split(".")[0]) for k, v in fields.iteritems() if not v)
+                loaded.update(name for name, key, c, a, kw in schema if not name in excluded)
+                return None if len(loaded) == len(schema) else frozenset(loaded)
+            fields = include
+        #a dotted key only loads part of it's field, the field is not loaded
+        loaded.update(names[k] for k in fields if k in names)
+        return None if len(loaded) == len(schema) else frozenset(loaded)
+
+    def _load(self, son, trusted=None):
+        self._id = son.get('_id', None)
+        self.__created__ = son.get('__created__', None)
+        self.__modified__ = son.get('__modified__', None)
+        self.__active__ = son.get('__active__', True)
+        self.__version__ = son.get('__version__', None)
+        trusted = self._trusted if trusted is None else trusted
+        self.__dict__["__trusted__"] = trusted
+        self._map(son, init=True, trusted=trusted)
+        idmap = IdentityMap.current()
+        if idmap is not None and self._id is not None: idmap.add(self)
+
+    def _doc(self, trusted=None, fields=None):
+        doc = self.__class__._son(self._id, fields=fields)
+        if doc: self._load(doc, trusted=trusted)
+
+    @classmethod
+    def _son(cls, _id, fields=None):
+        #the stored document with _id, read through the Model's _cache unless a projection is wanted
+        coll = cls._connection()
+        if cls._cache is None or fields is not None: return coll.find_one({'_id':_id}, fields=cls._projection(fields))
+        cache = cls._cache
+        _caches.add(cache)
+        son = cache.get(coll.full_name, _id)
+        if son is None:
+            writes = _cache_writes.get(coll.full_name, 0)
+            son = coll.find_one({'_id':_id})
+            if son is not None: _cache_set(cache, coll.full_name, [son], writes)
+        return son
+
+    @classmethod
+    def _by_id(cls, _id):
+        """the document with _id, through the IdentityMap and the Model's _cache, None if it does not exist"""
+        obj = cls._mapped(_id)
+        if obj is not None: return obj
+        son = cls._son(_id)
+        return cls._from_son(son) if son is not None else None
+
+    def _fetch(self, name):
+        """read the fields left out of the projection this document was loaded with, in a single query"""
+        d = self.__dict__
+        loaded = d["__loaded__"]
+        if not self._fetch_missing: raise NotLoadedException("%s was not loaded" % name)
+        keys = [key for n, key, c, a, kw in self.__class__._schema() if not n in loaded and not n in d and not issubclass(c, Lazy)]
+        doc = self._coll.find_one({'_id':self._id}, fields=keys) if self._id and keys else None
+        d["__loaded__"] = None
+        dirty = d["__dirty__"]
+        if doc: self._map(doc, init=True, trusted=d["__trusted__"])
+        d["__dirty__"] = dirty
+
+    @classmethod
+    def _mapped(cls, _id, fields=None):
+        #the instance of _id in the current IdentityMap, if it loaded the fields
+        idmap = IdentityMap.current()
+        if idmap is None or _id is None: return None
+        return idmap.get(cls, _id, fields)
+
+    @classmethod
+    def _projection(cls, fields):
+        #a versioned Model always reads back its __version__, partial documents can be saved
+        if not cls._versioned or not fields: return fields
+        if isinstance(fields, dict):
+            if not any(v for k, v in fields.iteritems() if k != "_id"): return fields
+            return dict(fields, __version__=True)
+        return list(fields) + ['__version__']
 
     @property
     def active(self):
@@ -655,20 +1219,37 @@ class Document(base):
     @classmethod
     def _connection(cls):
         _conn = _settings.DB_CONNECTION
+        try:
+            conn, coll = cls.__dict__["__coll__"]
+            if conn is _conn: return coll
+        except KeyError: pass
         _coll = _conn[cls._db][cls._collection]
+        cls.__coll__ = (_conn, _coll)
         return _coll
 
     @classmethod
     def find(cls, *args, **kwargs):
-        """returns pymongo cursor that yields instantiated Document objects of the Class type.
+        """returns a :class: `~Cursor` that yields instantiated Document objects of the Class type.
         :Parameters:
             - `*args`: passed directly to Connection.find()
             - `**kwargs`: passed directly to Connection.find()
 
-        extra kwargs paramter is as_dict this will return the raw dictionary from mongo, this also allows you to use the "fields" parameter
+        extra kwargs paramter is as_dict this will return the raw pymongo cursor, this also allows you to use the "fields" parameter
+        extra kwargs paramter trusted overrides the Model's _trusted setting for this query
+
+        documents found with a "fields" projection only map the projected fields, see :class: `~Document`
+
+        extra kwargs paramters batch_size and read_ahead control how the :class: `~Cursor` hydrates documents
         """
-        if not kwargs.get("as_dict", None): kwargs['as_class'] = cls
-        return cls._connection().find(*args, **kwargs)
+        trusted = kwargs.pop("trusted", None)
+        batch_size = kwargs.pop("batch_size", None)
+        read_ahead = kwargs.pop("read_ahead", False)
+        as_dict = kwargs.pop("as_dict", None)
+        fields = args[1] if len(args) > 1 else kwargs.get("fields", None)
+        if fields and not as_dict: args, kwargs = cls._projected(args, kwargs)
+        cur = cls._connection().find(*args, **kwargs)
+        if as_dict: return cur.batch_size(batch_size) if batch_size else cur
+        return Cursor(cur, cls, trusted=trusted, fields=fields, batch_size=batch_size, read_ahead=read_ahead)
 
     @classmethod
     def find_one(cls, *args, **kwargs):
@@ -677,8 +1258,24 @@ class Document(base):
             - `*args`: passed directly to Connection.find_one()
             - `**kwargs`: passed directly to Connection.find_one()
         """
-        if not kwargs.get("as_dict", None): kwargs['as_class'] = cls
-        return cls._connection().find_one(*args, **kwargs)
+        as_dict = kwargs.pop("as_dict", None)
+        trusted = kwargs.pop("trusted", None)
+        if cls._cache is not None and not as_dict and trusted is None and len(args) == 1 and not kwargs:
+            #lookups of a single _id go through the cache
+            ids = _spec_ids(args[0])
+            if ids is not None and len(ids) == 1 and (not isinstance(args[0], dict) or len(args[0]) == 1):
+                return cls._by_id(ids[0])
+        fields = args[1] if len(args) > 1 else kwargs.get("fields", None)
+        if fields and not as_dict: args, kwargs = cls._projected(args, kwargs)
+        doc = cls._connection().find_one(*args, **kwargs)
+        if as_dict or doc is None: return doc
+        return cls._from_son(doc, trusted=trusted, fields=fields)
+
+    @classmethod
+    def _projected(cls, args, kwargs):
+        #find args with the projection passed through _projection
+        if len(args) > 1: return (args[0], cls._projection(args[1])) + tuple(args[2:]), kwargs
+        return args, dict(kwargs, fields=cls._projection(kwargs["fields"]))
 
     @classmethod
     def __ensureindexes__(cls):
@@ -687,20 +1284,26 @@ class Document(base):
 
     @classmethod
     def __remove__(cls, *args, **kwargs):
-        cls._connection().remove(*args, **kwargs)
+        coll = cls._connection()
+        coll.remove(*args, **cls._concern(kwargs))
+        _written(coll, _spec_ids(args[0] if args else kwargs.get("spec_or_id", None)))
 
     @classmethod
     def __update__(cls, *args, **kwargs):
-        cls._connection().update(*args, **kwargs)
+        coll = cls._connection()
+        coll.update(*args, **cls._concern(kwargs))
+        _written(coll, _spec_ids(args[0] if args else kwargs.get("spec", None)))
 
     def remove(self):
         """Remove document. Calls .remove on pymongo Connection
 
         """
         self.__class__.__remove__({"_id":self._id})
+        idmap = IdentityMap.current()
+        if idmap is not None: idmap.discard(self)
 
     def update(self, update, **kwargs):
-        """Update itself. Allows for custom saving, ie; not using safe=True
+        """Update itself. Allows for custom saving, ie; a different write concern then the Model's _write_concern
         """
         self.__class__.__update__({"_id":self._id}, update, **kwargs)
 
@@ -713,40 +1316,836 @@ class Document(base):
         obj['__active__'] = self.active
         obj['__created__'] = self.created
         obj['__modified__'] = self.modified
+        if self._versioned: obj['__version__'] = self.__version__
+        return obj
+
+    def _insert(self):
+        #the document sent to mongo for a first save
+        self._save()
+        self.__created__ = datetime.datetime.utcnow()
+        self.__modified__ = datetime.datetime.utcnow()
+        self.__active__ = True
+        obj = self._json()
+        obj['__created__'] = self.__created__
+        obj['__modified__']= self.__modified__
+        obj['__active__'] = self.__active__
+        if self._versioned:
+            self.__version__ = 1
+            obj['__version__'] = self.__version__
         return obj
 
-    def save(self):
+    def _cascaded(self, build, cascade):
+        #builds the write for this document, the documents it cascades to are saved in bulk before it returns
+        if not cascade: return build()
+        with Session() as session:
+            session._cascading = True
+            self._cascade_refs(session)
+            return build()
+
+    def _referenced(self, field):
+        #remembers the DynamicDocument fields that dereferenced a document, for the cascade
+        self.__dict__.setdefault("__refs__", {})[id(field)] = field
+
+    def _cascade_refs(self, session):
+        #the changed documents dereferenced through this document are saved with it, even if it is unchanged itself
+        for field in self.__dict__.get("__refs__", {}).values(): field._cascade(session)
+
+    def _upsert(self, names, cascade=True):
+        #insert or update the document matching the values of names, reading back what was set on insert
+        changed = self._cascaded(self._save, cascade)
+        index = self.__class__._index()
+        now = datetime.datetime.utcnow()
+        obj = self._json()
+        spec = dict((index[name][1], obj.pop(index[name][1], None)) for name in names)
+        missing = [name for name in names if spec[index[name][1]] is None]
+        if missing: raise DocumentException(dict((name, FieldException("required to upsert")) for name in missing))
+        insert_only = set(key for name, key, cls, a, kw in self.__class__._schema() if getattr(cls, "_insert_only", False))
+        up = {'$set':{'__modified__':now}}
+        #only the values assigned are set, a matching document keeps the rest of it's fields
+        for key, val in changed.iteritems():
+            if key in spec or key.split(".")[0] in insert_only: continue
+            if isinstance(val, Modifier): up.setdefault(val.op, {})[key] = val.value
+            elif not val in (None, [], {}): up['$set'][key] = val
+        if self._versioned: up.setdefault('$inc', {})['__version__'] = 1
+        touched = set(key.split(".")[0] for op in up.values() for key in op)
+        on_insert = dict((key, val) for key, val in obj.iteritems() if not key in touched)
+        on_insert.update({'__created__':now, '__active__':True})
+        up['$setOnInsert'] = on_insert
+        fields = dict((key, True) for key in on_insert if key in insert_only or key.startswith("__"))
+        if self._versioned: fields['__version__'] = True
+        doc = self._coll.find_and_modify(spec, up, upsert=True, new=True, fields=fields)
+        self._id = doc['_id']
+        self.__created__ = doc.get('__created__', None)
+        self.__modified__ = now
+        self.__active__ = doc.get('__active__', True)
+        self.__version__ = doc.get('__version__', None)
+        for name, key, cls, a, kw in self.__class__._schema():
+            if key in insert_only and key in doc: self._get(name)._map(doc[key], init=True)
+        _written(self._coll, [self._id])
+        self._reset()
+        return self._id
+
+    def _update(self):
+        #the atomic update sent to mongo for an existing document
+        up = {'$set':{}}
+        for key, val in self._save().iteritems():
+            if isinstance(val, Modifier): up.setdefault(val.op, {})[key] = val.value
+            else: up['$set'][key] = val
+        self.__modified__ = datetime.datetime.utcnow()
+        up['$set']['__modified__'] = self.__modified__
+        if self._versioned: up.setdefault('$inc', {})['__version__'] = 1
+        return up
+
+    def _spec(self):
+        #the filter of an update, a versioned document only matches the version it was loaded with
+        spec = {'_id':self._id}
+        if self._versioned: spec['__version__'] = self.__version__
+        return spec
+
+    def _updated(self, result):
+        #check the result of a versioned update and move on to the next version
+        if not self._versioned: return
+        if result is not None and not result.get('n', 1):
+            raise ConflictException("%s %s was modified since version %s" % (self.__class__.__name__, self._id, self.__version__))
+        self.__version__ = (self.__version__ or 0) + 1
+
+    @classmethod
+    def _concern(cls, kwargs):
+        #pymongo write kwargs with the Model's write concern, unless they set their own
+        if any(k in kwargs for k in WRITE_CONCERN): return kwargs
+        return dict(cls._write_concern, **kwargs)
+
+    @classmethod
+    def insert_many(cls, docs, batch_size=1000, write_concern=None):
+        """insert many unsaved documents, batch_size at a time with unordered bulk inserts.
+
+        every document is validated first, documents with errors are skipped and the rest are still inserted.
+        inserted documents get their _id, created and modified dates.
+
+        returns a dict of the documents that were not inserted, position in docs: exception.
+        DocumentException for validation errors, pymongo OperationFailure for write errors.
+        write errors are not reported with an unacknowledged write concern.
+
+        :Parameters:
+            - `docs`: list of unsaved documents
+            - `batch_size`: number of documents sent to mongo per bulk insert
+            - `write_concern`: overrides the Model's _write_concern
+        """
+        wc = cls._write_concern if write_concern is None else write_concern
+        errors = {}
+        pending = []
+        with Session() as session:
+            #documents the inserts cascade to are written first, in bulk
+            session._cascading = cls._cascade
+            for i, doc in enumerate(docs):
+                errs = doc._errors()
+                if len(errs.keys()):
+                    errors[i] = DocumentException(errs)
+                else:
+                    obj = doc._insert()
+                    obj['_id'] = ObjectId()
+                    pending.append((i, doc, obj))
+        coll = cls._connection()
+        for start in xrange(0, len(pending), batch_size):
+            batch = pending[start:start+batch_size]
+            bulk = coll.initialize_unordered_bulk_op()
+            for i, doc, obj in batch: bulk.insert(obj)
+            failed = {}
+            try:
+                bulk.execute(write_concern=wc)
+            except pymongo.errors.BulkWriteError as e:
+                for err in e.details.get('writeErrors', []):
+                    failed[err['index']] = pymongo.errors.OperationFailure(err.get('errmsg'), err.get('code'))
+            for n, (i, doc, obj) in enumerate(batch):
+                if n in failed:
+                    errors[i] = failed[n]
+                    continue
+                doc._id = obj['_id']
+                doc._reset()
+            _written(coll, [obj['_id'] for n, (i, doc, obj) in enumerate(batch) if not n in failed])
+        if errors and _settings.LOGGER: _settings.LOGGER.error(errors)
+        return errors
+
+    def save(self, write_concern=None, upsert_on=None, cascade=None):
         """use this method to write a new object to the database or to save en existing document after updating.
 
-        if the document already exists it will send an atomic update of only the changed attributes to mongo.
+        if the document already exists it will send an atomic update of only the changed attributes to mongo,
+        nothing is sent if none changed.
 
-        always uses safe=True
+        writes with the Model's _write_concern, unless a write_concern is passed
+
+        upsert_on is a list of field names identifying the document, a new document then updates the one matching
+        those values or inserts it, with a single find_and_modify. only the fields assigned are updated. created, active and fields like AutoIncrement are only
+        set on insert and read back with the _id. these are written immediately, also inside a :class: `~Session`.
+
+        changed documents dereferenced through DynamicDocument fields are saved first, in one bulk write per collection.
+        cascade=False overrides the Model's _cascade and only saves this document.
 
         will raise a DocumentException if there are errors from validation, will also throw a pymongo Exception if insert or update fails.
+        a ConflictException if the Model is _versioned and the document was saved elsewhere since it was loaded.
+
+        inside a :class: `~Session` the document is validated and the write is deferred until the session is flushed.
 
         """
         errors = self._errors()
         if len(errors.keys()):
             self.logger.error(errors)
             raise DocumentException(errors)
-        if not self._id:
-            self._save()
-            self.__created__ = datetime.datetime.utcnow()
-            self.__modified__ = datetime.datetime.utcnow()
-            self.__active__ = True
-            obj = self._json()
-            obj['__created__'] = self.__created__
-            obj['__modified__']= self.__modified__
-            obj['__active__'] = self.__active__
-            self._id = self._coll.insert(obj, safe=True)
+        wc = self._write_concern if write_concern is None else write_concern
+        cascade = self._cascade if cascade is None else cascade
+        if upsert_on and not self._id: return self._upsert(upsert_on, cascade)
+        session = Session.current()
+        if session is not None:
+            insert = not self._id
+            if insert: self._id = ObjectId()
+            session.add(self, insert=insert, write_concern=wc, cascade=cascade)
+            return self._id
+        if not self._id and self._buffer is not None:
+            #the _id is only taken once the documents it cascades to were saved
+            obj = self._cascaded(self._insert, cascade)
+            self._id = obj['_id'] = ObjectId()
+            self._buffer.put(self, obj, wc)
+        elif not self._id:
+            self._id = self._coll.insert(self._cascaded(self._insert, cascade), **wc)
+            _written(self._coll, [self._id])
         else:
-            obj = self._save()
-            self.__modified__ = datetime.datetime.utcnow()
-            obj['__modified__'] = self.__modified__
-            up = {'$set':obj}
-            self._coll.update({'_id':self._id}, up, safe=True)
+            #an unchanged document is not written, like in a Session flush, the documents it cascades to still are
+            up = self._cascaded(lambda: self._update() if self._changed() else None, cascade)
+            if up is not None:
+                self._updated(self._coll.update(self._spec(), up, **wc))
+                _written(self._coll, [self._id])
+        self._reset()
+        idmap = IdentityMap.current()
+        if idmap is not None: idmap.add(self)
         return self._id
 
+class Cursor(object):
+    """Wraps a pymongo cursor, building a model of type for every document with :meth: `~Document._from_son`.
+
+    Cursor methods (sort, limit, skip, count, etc.) are passed through to pymongo.
+
+    With a batch_size documents are read from mongo and hydrated batch_size at a time, read_ahead = True reads the
+    next batch on a background thread while the current one is being consumed.
+
+    prefetch("owner") dereferences the DocumentId and DynamicDocument fields of a whole batch with one $in query
+    per referenced class, instead of one find_one per document. Lazy relations, prefetch("cars"), are loaded with one
+    query per batch and returned by all().
+    """
+    READ_AHEAD_BATCH_SIZE = 100
+
+    def __init__(self, cursor, type, trusted=None, fields=None, batch_size=None, read_ahead=False):
+        self._cursor = cursor
+        self._type = type
+        self._trusted = trusted
+        self._fields = fields
+        self._read_ahead = read_ahead
+        self._batch = collections.deque()
+        self._source = None
+        self._stop = threading.Event()
+        self._batch_size = None
+        self._prefetch = ()
+        if batch_size or read_ahead: self.batch_size(batch_size or self.READ_AHEAD_BATCH_SIZE)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._stop.is_set(): raise StopIteration
+        if not self._batch_size: return self._type._from_son(self._cursor.next(), trusted=self._trusted, fields=self._fields)
+        if not self._batch: self._batch.extend(self._hydrate(self._next_batch()))
+        return self._batch.popleft()
+
+    def iter_raw(self):
+        """yields the raw documents returned by pymongo, without building models"""
+        if not self._batch_size:
+            for son in self._cursor: yield son
+            return
+        while True:
+            try:
+                batch = self._next_batch()
+            except StopIteration: return
+            for son in batch: yield son
+
+    def iter_models(self):
+        """yields a model for every document, hydrated a batch at a time"""
+        return iter(self)
+
+    def batch_size(self, batch_size):
+        """sets the number of documents read from mongo and hydrated at a time
+
+        :Parameters:
+            - `batch_size`: number of documents per batch
+        """
+        self._cursor.batch_size(batch_size)
+        self._batch_size = batch_size
+        return self
+
+    def prefetch(self, *names):
+        """resolve the references in the named fields a batch at a time, sets a batch_size if there is none
+
+        :Parameters:
+            - `names`: DocumentId, DynamicDocument or Lazy field names, dotted to reach into embedded documents and lists
+        """
+        self._prefetch = self._prefetch + names
+        if not self._batch_size: self.batch_size(self.READ_AHEAD_BATCH_SIZE)
+        return self
+
+    def close(self):
+        """stops the read ahead thread, if any, and closes the pymongo cursor. iterating a closed Cursor stops"""
+        self._stop.set()
+        self._cursor.close()
+
+    def _hydrate(self, batch):
+        models = [self._type._from_son(son, trusted=self._trusted, fields=self._fields) for son in batch]
+        if self._prefetch: self._resolve(models)
+        return models
+
+    def _resolve(self, models):
+        #one query per referenced class, the fields referencing the same _id share the instance
+        refs = {}
+        for name in self._prefetch:
+            objs = models
+            for part in name.split("."):
+                objs = [o._get(part, fetch=False) for o in objs]
+                objs = [i for o in objs for i in (o if isinstance(o, List) else [o]) if i is not None]
+            lazies = [f for f in objs if isinstance(f, Lazy)]
+            if lazies: lazies[0]._fill(lazies)
+            for f in objs:
+                if isinstance(f, Lazy): continue
+                ref = f._reference()
+                if ref is None: continue
+                refs.setdefault(ref[0], {}).setdefault(ref[1], []).append(f)
+        for cls, ids in refs.iteritems():
+            for _id in ids.keys():
+                inst = cls._mapped(_id)
+                if inst is None: continue
+                for f in ids.pop(_id): f._resolved(inst)
+            if not ids: continue
+            coll = cls._connection()
+            sons = []
+            if cls._cache is not None:
+                _caches.add(cls._cache)
+                for _id in ids.keys():
+                    son = cls._cache.get(coll.full_name, _id)
+                    if son is not None: sons.append(son)
+            cached = set(son["_id"] for son in sons)
+            missing = [_id for _id in ids if not _id in cached]
+            if missing:
+                writes = _cache_writes.get(coll.full_name, 0)
+                found = list(coll.find({"_id":{"$in":missing}}))
+                if cls._cache is not None: _cache_set(cls._cache, coll.full_name, found, writes)
+                sons.extend(found)
+            for son in sons:
+                inst = cls._from_son(son)
+                for f in ids[son["_id"]]: f._resolved(inst)
+
+    def _next_batch(self):
+        if self._source is None:
+            if self._read_ahead: self._source = Cursor._reader(self._cursor, self._batch_size, self._stop)
+            else: self._source = Cursor._batches(self._cursor, self._batch_size)
+        return self._source.next()
+
+    @staticmethod
+    def _batches(cursor, batch_size):
+        while True:
+            batch = list(itertools.islice(cursor, batch_size))
+            if not batch: return
+            yield batch
+
+    @staticmethod
+    def _reader(cursor, batch_size, stop):
+        #a single batch is read ahead, the thread waits on the queue until it is taken.
+        #neither holds the Cursor, dropping it closes the generator and that stops the thread
+        queue = Queue.Queue(maxsize=1)
+        def put(item):
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return True
+                except Queue.Full: pass
+            return False
+        def read():
+            try:
+                for batch in Cursor._batches(cursor, batch_size):
+                    if not put(batch): return
+                put(None)
+            except Exception as e:
+                put(e)
+        thread = threading.Thread(target=read)
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                #close() stops the thread without it queueing the end, it may come from another thread
+                if stop.is_set(): return
+                try:
+                    batch = queue.get(timeout=0.1)
+                except Queue.Empty: continue
+                if batch is None: return
+                if isinstance(batch, Exception): raise batch
+                yield batch
+        finally:
+            stop.set()
+
+    def _wrap(self, cursor):
+        cur = Cursor(cursor, self._type, trusted=self._trusted, fields=self._fields, batch_size=self._batch_size, read_ahead=self._read_ahead)
+        cur._prefetch = self._prefetch
+        return cur
+
+    def __getitem__(self, index):
+        res = self._cursor[index]
+        if isinstance(res, pymongo.cursor.Cursor): return self._wrap(res)
+        return self._hydrate([res])[0]
+
+    def __getattr__(self, key):
+        attr = getattr(self._cursor, key)
+        if not callable(attr): return attr
+        def wrapped(*args, **kwargs):
+            res = attr(*args, **kwargs)
+            if res is self._cursor: return self
+            if isinstance(res, pymongo.cursor.Cursor): return self._wrap(res)
+            return res
+        return wrapped
+
+class Session(object):
+    """Unit of work, defers the writes of :meth: `~Document.save` until the session is flushed.
+
+    with Session():
+        human.save()
+        car.save()
+
+    Documents saved in the session are written once when it exits, however many times they were saved. On flush every
+    document is validated again, then inserts and updates are sent as one unordered bulk operation per collection
+    and write concern, the write concern of the last save of a document is used. Documents the saved documents
+    cascade to are written in the same flush.
+    Documents saved without changes since their last write are skipped. Nothing is written if the block raises.
+
+    A DocumentException is raised if any document fails validation, before anything is written, or if any writes fail,
+    with the errors keyed by document _id. Documents that failed to write stay in the session when flush() is called
+    directly, leaving the block discards them. New documents that are discarded without being written lose the _id
+    save() gave them, saving them again inserts them.
+    Updates of _versioned documents are sent one by one, a ConflictException in the errors leaves the document out.
+    """
+    _local = threading.local()
+
+    def __init__(self):
+        self._pending = []
+        self._index = {}
+        self._cascading = False
+
+    @classmethod
+    def current(cls):
+        """the innermost session of the current thread, or None"""
+        stack = getattr(cls._local, "stack", None)
+        return stack[-1] if stack else None
+
+    def __enter__(self):
+        if not hasattr(self._local, "stack"): self._local.stack = []
+        self._local.stack.append(self)
+        return self
+
+    def __exit__(self, type, value, tb):
+        self._local.stack.remove(self)
+        if type is not None:
+            self.clear()
+            return False
+        try:
+            self.flush()
+        except:
+            self.clear()
+            raise
+        return False
+
+    def add(self, doc, insert=False, write_concern=None, cascade=None):
+        """register a document to be written on flush, a document is only written once per flush
+
+        :Parameters:
+            - `doc`: the :class: `~Document`
+            - `insert`: the document is new and should be inserted
+            - `write_concern`: defaults to the document's _write_concern
+            - `cascade`: save the documents it dereferenced, defaults to the document's _cascade
+        """
+        wc = doc._write_concern if write_concern is None else write_concern
+        cascade = doc._cascade if cascade is None else cascade
+        i = self._index.get(id(doc), None)
+        if i is None:
+            self._index[id(doc)] = len(self._pending)
+            self._pending.append((doc, insert, wc, cascade))
+        else:
+            self._pending[i] = (doc, insert or self._pending[i][1], wc, cascade)
+
+    def clear(self):
+        """forget every pending document without writing it, new documents get their _id taken back"""
+        for doc, insert, wc, cascade in self._pending:
+            if insert:
+                doc._id = None
+                doc.__version__ = None
+        self._forget()
+
+    def _forget(self):
+        self._pending = []
+        self._index = {}
+
+    def flush(self):
+        """write every pending document, one bulk operation per collection"""
+        errors = {}
+        for doc, insert, wc, cascade in self._pending:
+            errs = doc._errors()
+            if len(errs.keys()): errors[doc._id] = DocumentException(errs)
+        if errors:
+            if _settings.LOGGER: _settings.LOGGER.error(errors)
+            raise DocumentException(errors)
+        colls = {}
+        order = []
+        ops = []
+        #documents saved by cascades while the writes are built are added to this flush
+        self.__enter__()
+        try:
+            i = 0
+            checked = len(self._pending)
+            while i < len(self._pending):
+                doc, insert, wc, cascade = self._pending[i]
+                i += 1
+                if i > checked:
+                    errs = doc._errors()
+                    if len(errs.keys()):
+                        errors[doc._id] = DocumentException(errs)
+                        continue
+                self._cascading = cascade
+                if cascade: doc._cascade_refs(self)
+                if insert:
+                    obj = doc._insert()
+                    obj['_id'] = doc._id
+                    ops.append((doc, obj, None, wc))
+                elif doc._changed(): ops.append((doc, None, doc._update(), wc))
+                else: doc._reset()
+        finally:
+            self._local.stack.remove(self)
+            self._cascading = False
+        if errors:
+            if _settings.LOGGER: _settings.LOGGER.error(errors)
+            raise DocumentException(errors)
+        for doc, obj, up, wc in ops:
+            coll = doc._coll
+            key = (coll.full_name, tuple(sorted(wc.items())))
+            if not key in colls:
+                colls[key] = (coll, wc, [])
+                order.append(key)
+            colls[key][2].append((doc, obj, up))
+        failed = []
+        #collections first reached through a cascade are written before the documents that reference them
+        for key in reversed(order):
+            coll, wc, ops = colls[key]
+            ids = [doc._id for doc, obj, up in ops]
+            #a bulk result does not tell which update matched, versioned updates are checked one by one
+            for doc, obj, up in ops:
+                if obj is not None or not doc._versioned: continue
+                try:
+                    doc._updated(coll.update(doc._spec(), up, **wc))
+                    doc._reset()
+                except ConflictException as e: errors[doc._id] = e
+                except pymongo.errors.OperationFailure as e:
+                    errors[doc._id] = e
+                    failed.append((doc, False, wc))
+            ops = [op for op in ops if op[1] is not None or not op[0]._versioned]
+            if not ops:
+                _written(coll, ids)
+                continue
+            bulk = coll.initialize_unordered_bulk_op()
+            for doc, obj, up in ops:
+                if obj is not None: bulk.insert(obj)
+                else: bulk.find({'_id':doc._id}).update_one(up)
+            errs = {}
+            try:
+                bulk.execute(write_concern=wc)
+            except pymongo.errors.BulkWriteError as e:
+                for err in e.details.get('writeErrors', []):
+                    errs[err['index']] = pymongo.errors.OperationFailure(err.get('errmsg'), err.get('code'))
+            for n, (doc, obj, up) in enumerate(ops):
+                if n in errs:
+                    errors[doc._id] = errs[n]
+                    failed.append((doc, obj is not None, wc))
+                else: doc._reset()
+            _written(coll, ids)
+        cascades = dict((id(doc), cascade) for doc, insert, wc, cascade in self._pending)
+        self._forget()
+        for doc, insert, wc in failed: self.add(doc, insert=insert, write_concern=wc, cascade=cascades[id(doc)])
+        if errors:
+            if _settings.LOGGER: _settings.LOGGER.error(errors)
+            raise DocumentException(errors)
+
+class IdentityMap(object):
+    """Keeps one instance per document, keyed by collection and _id, for as long as the block runs.
+
+    with IdentityMap():
+        human = Human(id=_id)
+        human is Human.find_one({"_id":_id})
+
+    Documents loaded inside the block are mapped and later queries return the mapped instance instead of hydrating
+    the document again, Document(id=...) and dereferencing DocumentId and DynamicDocument fields skip the query too.
+    Mapped instances are not refreshed, a query sees the changes made to them in memory, saved or not.
+    A document loaded with a projection is only reused by queries of the same fields or fewer.
+
+    Maps are per thread and can be nested, only the innermost one is used. Start one per request or task.
+    """
+    _local = threading.local()
+
+    def __init__(self):
+        self._docs = {}
+
+    @classmethod
+    def current(cls):
+        """the innermost identity map of the current thread, or None"""
+        stack = getattr(cls._local, "stack", None)
+        return stack[-1] if stack else None
+
+    def __enter__(self):
+        if not hasattr(self._local, "stack"): self._local.stack = []
+        self._local.stack.append(self)
+        return self
+
+    def __exit__(self, type, value, tb):
+        self._local.stack.remove(self)
+        self.clear()
+        return False
+
+    def get(self, cls, _id, fields=None):
+        """the mapped instance of cls with _id, None if it is not mapped, is of another class or did not load the fields
+
+        :Parameters:
+            - `cls`: the :class: `~Document` class
+            - `_id`: the document _id
+            - `fields`: the projection the instance should have loaded
+        """
+        obj = self._docs.get((cls._connection().full_name, _id), None)
+        if obj is None or not isinstance(obj, cls): return None
+        loaded = obj.__dict__["__loaded__"]
+        if loaded is None: return obj
+        want = cls._loaded(fields)
+        return obj if want is not None and want <= loaded else None
+
+    def add(self, doc):
+        """map a document, replacing the instance mapped to it's _id"""
+        self._docs[(doc._coll.full_name, doc._id)] = doc
+
+    def discard(self, doc):
+        """unmap a document"""
+        key = (doc._coll.full_name, doc._id)
+        if self._docs.get(key, None) is doc: del self._docs[key]
+
+    def clear(self):
+        """unmap every document"""
+        self._docs = {}
+
+_buffers = weakref.WeakSet()
+
+@atexit.register
+def _close_buffers():
+    for buf in list(_buffers): buf.close()
+
+class WriteBuffer(object):
+    """Write behind buffer for the inserts of append only Models, log entries or events.
+
+    class Event(Document):
+        _buffer = WriteBuffer(size=10000, batch_size=500, interval=1.0)
+
+    Event().save() assigns the _id and queues the document, a background thread inserts queued documents in unordered
+    bulk inserts once batch_size are queued or interval seconds after the first one. save() blocks while the queue is
+    full. Updates are not buffered, a buffered document should not be saved again until it is flushed.
+
+    Errors are passed to on_error(doc, exception), or logged. flush() waits for every queued document to be written,
+    buffers are closed and flushed when the interpreter exits.
+
+    :Parameters:
+        - `size`: maximum number of queued documents
+        - `batch_size`: maximum number of documents per bulk insert
+        - `interval`: seconds a queued document waits for a batch to fill
+        - `timeout`: seconds save() waits on a full queue before raising Queue.Full, forever by default
+        - `on_error`: callable taking the document and the exception of a failed insert
+    """
+
+    def __init__(self, size=10000, batch_size=500, interval=1.0, timeout=None, on_error=None):
+        self._queue = Queue.Queue(maxsize=size)
+        self._batch_size = batch_size
+        self._interval = interval
+        self._timeout = timeout
+        self._on_error = on_error
+        self._urgent = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+        _buffers.add(self)
+
+    def put(self, doc, obj, write_concern):
+        """queue the insert of obj, the son of doc"""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._closed = False
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+        self._queue.put((doc, obj, write_concern), True, self._timeout)
+
+    def flush(self):
+        """write every queued document, returns once they are written"""
+        self._urgent.set()
+        try:
+            self._queue.join()
+        finally:
+            self._urgent.clear()
+
+    def close(self):
+        """flush and stop the background thread"""
+        self.flush()
+        self._closed = True
+        if self._thread is not None: self._thread.join()
+
+    def _run(self):
+        while True:
+            try:
+                batch = [self._queue.get(timeout=self._interval)]
+            except Queue.Empty:
+                if self._closed: return
+                continue
+            deadline = time.time() + self._interval
+            while len(batch) < self._batch_size:
+                remaining = 0 if self._urgent.is_set() else deadline - time.time()
+                try:
+                    batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+                except Queue.Empty: break
+            try:
+                self._write(batch)
+            finally:
+                for item in batch: self._queue.task_done()
+
+    def _write(self, batch):
+        groups = collections.OrderedDict()
+        for doc, obj, wc in batch:
+            key = (doc._coll.full_name, tuple(sorted(wc.items())))
+            groups.setdefault(key, (doc._coll, wc, []))[2].append((doc, obj))
+        for coll, wc, items in groups.values():
+            errors = {}
+            try:
+                bulk = coll.initialize_unordered_bulk_op()
+                for doc, obj in items: bulk.insert(obj)
+                bulk.execute(write_concern=wc)
+            except pymongo.errors.BulkWriteError as e:
+                for err in e.details.get('writeErrors', []):
+                    errors[err['index']] = pymongo.errors.OperationFailure(err.get('errmsg'), err.get('code'))
+            except Exception as e:
+                errors = dict((n, e) for n in xrange(len(items)))
+            _written(coll, [doc._id for n, (doc, obj) in enumerate(items) if not n in errors])
+            for n, e in errors.iteritems(): self._error(items[n][0], e)
+
+    def _error(self, doc, e):
+        if self._on_error is not None:
+            try:
+                self._on_error(doc, e)
+            except Exception as err:
+                if _settings.LOGGER: _settings.LOGGER.exception(err)
+        elif _settings.LOGGER: _settings.LOGGER.error("buffered insert of %s failed: %s" % (doc._id, e))
+
+_caches = weakref.WeakSet()
+_cache_writes = {}
+_cache_lock = threading.Lock()
+
+@on_write
+def _invalidate_caches(collection, ids):
+    with _cache_lock:
+        _cache_writes[collection] = _cache_writes.get(collection, 0) + 1
+        for cache in list(_caches): cache.invalidate(collection, ids)
+
+def _cache_set(cache, collection, sons, writes):
+    #documents read while the collection was written to could be stale, they are not cached
+    with _cache_lock:
+        if _cache_writes.get(collection, 0) != writes: return
+        for son in sons: cache.set(collection, son["_id"], son)
+
+class Cache(object):
+    """Interface of the document cache set as a Model's _cache, implement it to keep documents in an external store.
+
+    Documents are the raw dicts read from mongo, keyed by collection full name and _id. Writes sent through humongolus
+    invalidate the documents they touch, writes made elsewhere are only picked up when an entry expires.
+    hits and misses count the lookups.
+    """
+    hits = 0
+    misses = 0
+
+    def get(self, collection, _id):
+        """the cached document, None on a miss"""
+        raise NotImplementedError()
+
+    def set(self, collection, _id, son):
+        """cache a document"""
+        raise NotImplementedError()
+
+    def invalidate(self, collection, ids=None):
+        """drop the documents of collection with ids, or all of them if ids is None"""
+        raise NotImplementedError()
+
+    def clear(self):
+        """drop every document"""
+        raise NotImplementedError()
+
+class LRUCache(Cache):
+    """In process :class: `~Cache`, evicts the least recently used document past size documents.
+
+    class Human(Document):
+        _cache = LRUCache(size=5000, ttl=60)
+
+    The cache can be shared by Models, one per process is enough. A copy of the stored document is returned on each hit.
+    """
+
+    def __init__(self, size=10000, ttl=None):
+        """
+        :Parameters:
+            - `size`: maximum number of documents
+            - `ttl`: seconds a document is kept, forever if None
+        """
+        self._size = size
+        self._ttl = ttl
+        self._docs = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, collection, _id):
+        key = (collection, _id)
+        with self._lock:
+            try:
+                expires, son = self._docs.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            if expires is not None and expires < time.time():
+                self.misses += 1
+                return None
+            self._docs[key] = (expires, son)
+            self.hits += 1
+        return copy.deepcopy(son)
+
+    def set(self, collection, _id, son):
+        expires = time.time() + self._ttl if self._ttl else None
+        son = copy.deepcopy(son)
+        with self._lock:
+            self._docs.pop((collection, _id), None)
+            self._docs[(collection, _id)] = (expires, son)
+            while len(self._docs) > self._size: self._docs.popitem(last=False)
+
+    def invalidate(self, collection, ids=None):
+        with self._lock:
+            if ids is None:
+                for key in [key for key in self._docs if key[0] == collection]: del self._docs[key]
+            else:
+                for _id in ids: self._docs.pop((collection, _id), None)
+
+    def clear(self):
+        with self._lock:
+            self._docs.clear()
+
+    def __len__(self):
+        return len(self._docs)
+
 class Index(object):
     DESCENDING = pymongo.DESCENDING
     ASCENDING = pymongo.ASCENDING
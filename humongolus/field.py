@@ -1,6 +1,9 @@
+import copy
 import datetime
 import re
-from humongolus import Field, FieldException, Document, import_class, _settings
+import time
+import threading
+from humongolus import Field, FieldException, Document, Session, Modifier, import_class, on_write, _settings
 from bson.objectid import ObjectId
 from gridfs import GridFS
 import iso8601
@@ -60,6 +63,19 @@ class Integer(Char):
         except FieldException as e: raise e
         except: raise FieldException("%s is not a valid %s" % (val, self._exception_display))
 
+    def inc(self, n=1):
+        """add n to the value, saved with $inc so concurrent increments are not lost. folded into the $set if the value was also assigned"""
+        inc = self._op.value if self._op is not None else 0 if self._value == self._dirty else None
+        stored = self._dirty
+        try:
+            self._clean((self._value or 0) + n)
+        except FieldException as e:
+            self._error = e
+            return
+        if inc is not None:
+            self._op = Modifier("$inc", inc + n)
+            self._dirty = stored
+
 class Float(Integer):
     _type=float
     _exception_display ="float"
@@ -115,18 +131,59 @@ class DocumentId(Field):
 
     def __call__(self):
         if not self._value is None and self._type:
-            return self._type(id=self._value)
+            inst = getattr(self, "__docinst__", None)
+            if inst is None or inst._id != self._value: inst = self.__docinst__ = self._type(id=self._value)
+            return inst
         else: raise FieldException("Cannot instantiate %s with id %s" % (self._type, self._value))
 
+    def _reference(self):
+        #the class and _id a Cursor.prefetch resolves, None if there is nothing to fetch
+        if self._value is None or not self._type: return None
+        inst = getattr(self, "__docinst__", None)
+        if inst is not None and inst._id == self._value: return None
+        return self._type, self._value
+
+    def _resolved(self, inst):
+        self.__docinst__ = inst
+
+
+_sequences = {}
+_sequences_lock = threading.Lock()
+
+def _reserve(coll, name, block):
+    #the last id of the next block, a single $inc
+    return coll.find_and_modify({"field":name}, {"$inc":{"val":block}}, upsert=True, new=True, fields={"val":True})['val']
+
+def _next_sequence(coll, name, block):
+    #hands out the ids of a block reserved with a single $inc, reserving the next block when it runs out.
+    #the module lock only guards the registry, each sequence has it's own lock for the round trip
+    if block == 1: return _reserve(coll, name, 1)
+    key = (coll.full_name, name)
+    with _sequences_lock:
+        seq = _sequences.get(key, None)
+        if seq is None: seq = _sequences[key] = [1, 0, threading.Lock()]
+    with seq[2]:
+        if seq[0] > seq[1]:
+            val = _reserve(coll, name, block)
+            seq[0], seq[1] = val-block+1, val
+        val = seq[0]
+        seq[0] += 1
+        return val
 
 class AutoIncrement(Integer):
+    """Integer assigned from a sequence in the AUTOINC_DB_NAME database on first save.
+
+    block reserves that many ids at a time with one round trip, shared by every thread in the process.
+    ids left in a block when the process exits are never used, so the sequence can have gaps.
+    """
     _collection = None
+    _block = 1
+    _insert_only = True
 
     def _save(self, namespace):
         if self._value == None:
             col = self._collection if self._collection else "sequence"
-            res = self._conn[_settings.AUTOINC_DB_NAME][col].find_and_modify({"field":self._name}, {"$inc":{"val":1}}, upsert=True, new=True, fields={"val":True})
-            self._value = res['val']
+            self._value = _next_sequence(self._conn[_settings.AUTOINC_DB_NAME][col], self._name, self._block)
 
         return super(AutoIncrement, self)._save(namespace)
 
@@ -146,19 +203,36 @@ class DynamicDocument(Field):
     def __call__(self):
         if isinstance(self._value, dict):
             cls = import_class(self._value['cls'])
-            if not (hasattr(self, "__dyninst__") and self.__dyninst__._id == self._value['_id']):
-                self.__dyninst__ = cls.find_one({"_id": self._value['_id']})
+            if not (getattr(self, "__dyninst__", None) is not None and self.__dyninst__._id == self._value['_id']):
+                self._resolved(cls._by_id(self._value['_id']))
             return self.__dyninst__
         elif self._value == None:
             return self._value
         else: raise Exception("Bad Value: %s" % self._value)
 
+    def _reference(self):
+        #the class and _id a Cursor.prefetch resolves, None if there is nothing to fetch
+        if not isinstance(self._value, dict): return None
+        inst = getattr(self, "__dyninst__", None)
+        if inst is not None and inst._id == self._value['_id']: return None
+        return import_class(self._value['cls']), self._value['_id']
+
+    def _resolved(self, inst):
+        self.__dyninst__ = inst
+        #the dereferenced document may be changed, saving the document this field belongs to cascades to it
+        if inst is not None and isinstance(self._base, Document): self._base._referenced(self)
+
     def _get_value(self):
         return self()
 
+    def _cascade(self, session):
+        #the dereferenced document is saved in bulk before the parent write if it changed, see Document.save
+        inst = getattr(self, "__dyninst__", None)
+        if inst is not None and inst._changed(): session.add(inst)
+
     def _save(self, namespace):
-        if hasattr(self, "__dyninst__"):
-            self.__dyninst__.save()
+        session = Session.current()
+        if session is not None and session._cascading: self._cascade(session)
         return super(DynamicDocument, self)._save(namespace)
 
 
@@ -203,37 +277,96 @@ class Choice(Char):
     def get_choices(self, render=None):
         return self._choices
 
+_choices = {}
+_choices_lock = threading.Lock()
+_choices_writes = {} #None counts the invalidations of every collection
+
+def _freeze(val):
+    #a hashable copy of a query, projection or sort
+    if isinstance(val, dict): return tuple(sorted((k, _freeze(v)) for k, v in val.iteritems()))
+    if isinstance(val, (list, tuple)): return tuple(_freeze(v) for v in val)
+    return val
+
+def _cached_choices(coll, query, fields, sort, ttl):
+    #the documents a choice field lists, read once per ttl seconds for every field with the same query
+    if not ttl:
+        cur = coll.find(query, fields=fields)
+        return list(cur.sort(sort) if sort else cur)
+    key = (coll.full_name, _freeze(query), _freeze(fields), _freeze(sort))
+    now = time.time()
+    with _choices_lock:
+        hit = _choices.get(key, None)
+        writes = (_choices_writes.get(None, 0), _choices_writes.get(coll.full_name, 0))
+    #copies, a render that changes a document mustn't change the cached one
+    if hit is not None and hit[0] > now: return copy.deepcopy(hit[1])
+    cur = coll.find(query, fields=fields)
+    docs = list(cur.sort(sort) if sort else cur)
+    with _choices_lock:
+        #not cached if the collection was written to while it was read
+        if (_choices_writes.get(None, 0), _choices_writes.get(coll.full_name, 0)) == writes: _choices[key] = (now + ttl, copy.deepcopy(docs))
+    return docs
+
+def invalidate_choices(collection=None):
+    """Drop the cached choices of ModelChoice and CollectionChoice fields. writes sent through humongolus drop them already.
+
+    :Parameters:
+        - `collection`: full name of the collection, "db.collection", every collection if None
+    """
+    with _choices_lock:
+        _choices_writes[collection] = _choices_writes.get(collection, 0) + 1
+        if collection is None: _choices.clear()
+        else:
+            for key in [key for key in _choices if key[0] == collection]: del _choices[key]
+
+@on_write
+def _invalidate_choices(collection, ids):
+    invalidate_choices(collection)
+
 class ModelChoice(DocumentId):
+    """DocumentId selected from the documents of type matching query, rendered as choices by a Select widget.
+
+    The choices are cached for ttl seconds, shared by fields with the same query, fields and sort. ttl=0 turns it off.
+    """
     _type = None
     _render = None
     _fields = None
     _query = {}
     _sort = {}
+    _ttl = 60
 
     def get_choices(self, render=None):
         if render:
-            cur = self._type.find(self._query, fields=self._fields)
-            cur = cur.sort(self._sort) if self._sort else cur
-            return [render(i) for i in cur]
+            docs = _cached_choices(self._type._connection(), self._query, self._fields, self._sort, self._ttl)
+            return [render(self._type._from_son(doc, fields=self._fields)) for doc in docs]
         else: raise FieldException("no render method available")
 
+    def invalidate(self):
+        """drop the cached choices of the collection"""
+        invalidate_choices(self._type._connection().full_name)
+
 class CollectionChoice(Choice):
+    """Choice of the documents in _db._collection matching query, rendered by a Select widget.
+
+    The choices are cached for ttl seconds, shared by fields with the same query, fields and sort. ttl=0 turns it off.
+    """
     _db = None
     _collection = None
     _render = None
     _fields = None
     _query = {}
     _sort = {}
+    _ttl = 60
 
     def get_choices(self, render=None):
         if render:
-            print self._db
-            print self._collection
-            cur = self._conn[self._db][self._collection].find(self._query, fields=self._fields)
-            cur = cur.sort(self._sort) if self._sort else cur
-            return [render(i) for i in cur]
+            docs = _cached_choices(self._conn[self._db][self._collection], self._query, self._fields, self._sort, self._ttl)
+            return [render(doc) for doc in docs]
         else: raise FieldException("no render method available")
 
+    def invalidate(self):
+        """drop the cached choices of the collection"""
+        invalidate_choices(self._conn[self._db][self._collection].full_name)
+
 class Regex(Char):
     _reg = None
     _disp_error = None
@@ -42,6 +42,35 @@ class Female(Human):
 class Male(Human):
     genitalia = field.Char(default='outy')
 
+class LazyFemale(Female):
+    _lazy = True
+
+class Event(orm.Document):
+    _db = "test"
+    _collection = "events"
+    _buffer = orm.WriteBuffer(size=100, batch_size=10, interval=0.1)
+    message = field.Char()
+    at = field.TimeStamp()
+    source = field.DynamicDocument()
+
+class Ticket(orm.Document):
+    _db = "test"
+    _collection = "tickets"
+    number = field.AutoIncrement(collection="ticket", block=10)
+
+class Account(orm.Document):
+    _db = "test"
+    _collection = "accounts"
+    _versioned = True
+    owner = field.Char()
+    balance = field.Integer()
+
+class Author(orm.Document):
+    _db = "test"
+    _collection = "authors"
+    _cache = orm.LRUCache(size=2)
+    name = field.Char()
+
 class Car(orm.Document):
     _db = "test"
     _collection = "cars"
@@ -4,12 +4,15 @@ if sys.version_info < (2,7):
 else:
     import unittest
 import datetime
+import threading
+import time
 import objects
 import os
 from pymongo.connection import Connection
 import logging
 import humongolus as orm
 import humongolus.widget as widget
+import humongolus.field as field
 from humongolus.field import FieldException
 
 conn = Connection()
@@ -111,6 +114,19 @@ class Field(unittest.TestCase):
         self.assertEqual(n_obj.human_id, new_val)
         self.assertEqual(n_obj.name, n)
     
+    def test_autoincrement_block(self):
+        last_val = conn["auto_increment"]["ticket"].find_one({"field":"number"}, fields={"val":True})
+        last_val = last_val["val"] if last_val else 0
+        numbers = []
+        for i in xrange(3):
+            ticket = objects.Ticket()
+            ticket.save()
+            numbers.append(ticket.number)
+        self.assertEqual(numbers, [last_val+1, last_val+2, last_val+3])
+        seq = conn["auto_increment"]["ticket"].find_one({"field":"number"}, fields={"val":True})
+        self.assertEqual(seq["val"], last_val+10)
+        objects.Ticket.__remove__()
+
     def test_dynamic_document(self):
         self.obj.name = self.name
         _id = self.obj.save()
@@ -130,6 +146,64 @@ class Field(unittest.TestCase):
             car3._get("any_owner")()
 
     
+    def test_cascade(self):
+        self.obj.name = self.name
+        _id = self.obj.save()
+        scion = objects.Scion()
+        scion.any_owner = self.obj
+        s_id = scion.save()
+        scion = objects.Scion(id=s_id)
+        self.assertEqual(scion.any_owner._id, _id)
+        self.assertEqual(scion._changed(), [])
+        scion.any_owner.age = 30
+        self.assertEqual(scion._changed(), [])
+        scion.save()
+        self.assertEqual(objects.Female(id=_id).age, 30)
+        scion.any_owner.age = 31
+        scion.save(cascade=False)
+        self.assertEqual(objects.Female(id=_id).age, 30)
+        scion.any_owner.age = -1
+        with self.assertRaises(orm.DocumentException) as cm:
+            scion.save()
+        objects.Scion.__remove__()
+
+    def test_prefetch(self):
+        self.obj.name = self.name
+        _id = self.obj.save()
+        for i in xrange(3):
+            scion = objects.Scion()
+            scion.owner = _id
+            scion.any_owner = self.obj
+            scion.save()
+        scions = list(objects.Scion.find({"owner":_id}).prefetch("owner", "any_owner"))
+        self.assertEqual(len(scions), 3)
+        for scion in scions:
+            self.assertIsNotNone(scion._get("owner").__docinst__)
+            self.assertIs(scion._get("any_owner").__dyninst__, scions[0]._get("any_owner").__dyninst__)
+            self.assertEqual(scion._get("owner")().name, self.name)
+            self.assertEqual(scion.any_owner._id, _id)
+        objects.Scion.__remove__()
+
+    def test_identity_map(self):
+        self.obj.name = self.name
+        _id = self.obj.save()
+        car = objects.Car()
+        car.owner = _id
+        car_id = car.save()
+        with orm.IdentityMap():
+            human = objects.Female(id=_id)
+            self.assertIs(objects.Female.find_one({"_id":_id}), human)
+            self.assertIs(list(objects.Female.find({"_id":_id}))[0], human)
+            self.assertIs(objects.Female(id=_id), human)
+            self.assertIs(objects.Car(id=car_id)._get("owner")(), human)
+        with orm.IdentityMap():
+            partial = objects.Car.find_one({"_id":car_id}, fields=["make"])
+            car = objects.Car(id=car_id)
+            self.assertIsNot(car, partial)
+            self.assertIs(objects.Car.find_one({"_id":car_id}, fields=["make"]), car)
+        self.assertIsNot(objects.Female(id=_id), human)
+        objects.Car.__remove__()
+
     def compare_date(self, date1, date2):
         #mongo doesn't support the same date precision as python, gotta chop off a few microseconds
         diff = date1-date2
@@ -290,6 +364,103 @@ class Find(unittest.TestCase):
         
         self.assertEqual(ids, self.ids)
     
+    def test_cursor(self):
+        cur = objects.Female.find().sort('_id').limit(2)
+        self.assertIsInstance(cur, orm.Cursor)
+        objs = list(cur)
+        self.assertEqual([o._id for o in objs], self.ids[:2])
+        self.assertEqual(objs[0].name, "Anne0")
+        self.assertEqual(objs[0].created.__class__, datetime.datetime)
+        self.assertEqual(objects.Female.find().sort('_id')[1]._id, self.ids[1])
+        self.assertEqual(objects.Female.find().count(), 5)
+
+    def test_batches(self):
+        ids = [o._id for o in objects.Female.find(batch_size=2).sort('_id')]
+        self.assertEqual(ids, self.ids)
+        ids = [o._id for o in objects.Female.find(read_ahead=True, batch_size=2).sort('_id').iter_models()]
+        self.assertEqual(ids, self.ids)
+        docs = list(objects.Female.find(batch_size=2).sort('_id').iter_raw())
+        self.assertEqual([d["_id"] for d in docs], self.ids)
+        self.assertEqual(docs[0].__class__, dict)
+
+    def test_read_ahead_abandoned(self):
+        threads = threading.active_count()
+        for i in xrange(3):
+            for obj in objects.Female.find(read_ahead=True, batch_size=1): break
+        time.sleep(0.5)
+        self.assertEqual(threading.active_count(), threads)
+
+    def test_read_ahead_close(self):
+        cur = objects.Female.find(read_ahead=True, batch_size=1)
+        cur.next()
+        cur.close()
+        self.assertEqual(list(cur), [])
+        cur = objects.Female.find(read_ahead=True, batch_size=1)
+        cur.next()
+        consumer = threading.Thread(target=lambda: list(cur))
+        consumer.start()
+        cur.close()
+        consumer.join(2)
+        self.assertFalse(consumer.is_alive())
+
+    def test_insert_many(self):
+        docs = []
+        for i in xrange(5):
+            obj = objects.Female()
+            obj.name = "Beth%s" % i
+            docs.append(obj)
+        docs[2].name = "B"
+        errors = objects.Female.insert_many(docs, batch_size=2)
+        self.assertEqual(errors.keys(), [2])
+        self.assertIsInstance(errors[2], orm.DocumentException)
+        self.assertEqual(docs[2]._id, None)
+        self.assertEqual(objects.Female.find().count(), len(self.ids) + 4)
+        self.assertEqual(objects.Female(id=docs[4]._id).name, "Beth4")
+        self.assertEqual(docs[0].created.__class__, datetime.datetime)
+
+    def test_session(self):
+        obj = objects.Female(id=self.ids[0])
+        with orm.Session() as session:
+            new = objects.Female()
+            new.name = "Beth"
+            _id = new.save()
+            new.age = 20
+            new.save()
+            obj.age = 30
+            obj.save()
+            self.assertEqual(objects.Female.find_one({"_id":_id}), None)
+            self.assertEqual(objects.Female(id=self.ids[0]).age, None)
+        self.assertEqual(objects.Female(id=_id).age, 20)
+        self.assertEqual(objects.Female(id=self.ids[0]).age, 30)
+        self.assertEqual(orm.Session.current(), None)
+        with self.assertRaises(ValueError) as cm:
+            with orm.Session():
+                obj.age = 40
+                obj.save()
+                raise ValueError()
+        self.assertEqual(objects.Female(id=self.ids[0]).age, 30)
+        new = objects.Female()
+        new.name = "Cleo"
+        with self.assertRaises(ValueError) as cm:
+            with orm.Session():
+                new.save()
+                raise ValueError()
+        self.assertEqual(new._id, None)
+        _id = new.save()
+        self.assertEqual(objects.Female(id=_id).name, "Cleo")
+
+    def test_trusted(self):
+        objects.Female.__update__({"_id":self.ids[0]}, {"$set":{"age":-5}})
+        obj = objects.Female.find_one({"_id":self.ids[0]}, trusted=True)
+        self.assertEqual(obj.age, -5)
+        self.assertEqual(obj._get("age")._error, None)
+        with self.assertRaises(orm.DocumentException) as cm:
+            obj.save()
+        obj2 = objects.Female.find_one({"_id":self.ids[0]})
+        self.assertEqual(obj2._get("age")._error.__class__.__name__, "MinException")
+        obj.age = 30
+        obj.save()
+
     def test_fields(self):
         for obj in objects.Female.find(as_dict=True, fields={"genitalia":True}):
             self.assertEqual(obj.get('name', None), None)
@@ -298,6 +469,47 @@ class Find(unittest.TestCase):
         obj = objects.Female.find_one({"_id":self.ids[0]}, as_dict=True, fields={"genitalia":True})
         self.assertEqual(obj.get("genitalia", None), self.genitalia)
     
+    def test_projection(self):
+        obj = objects.Female.find({"_id":self.ids[0]}, fields=["name"])[0]
+        self.assertEqual(obj.name, "Anne0")
+        self.assertEqual(obj._json(), {"name":u"Anne0"})
+        with self.assertRaises(orm.NotLoadedException) as cm:
+            obj.genitalia
+        obj.age = 30
+        self.assertEqual(obj._save(), {"age":30})
+        obj.save()
+        self.assertEqual(objects.Female.find_one({"_id":self.ids[0]}).genitalia, self.genitalia)
+        objects.Female._fetch_missing = True
+        try:
+            obj = objects.Female(id=self.ids[0], fields={"genitalia":False})
+            self.assertEqual(obj.age, 30)
+            self.assertEqual(obj.genitalia, self.genitalia)
+        finally:
+            objects.Female._fetch_missing = False
+
+    def test_dotted_projection(self):
+        obj = objects.Female()
+        obj.name = "Beth"
+        for title in ["Nurse", "Pilot"]:
+            job = objects.Job()
+            job.title = title
+            job.employer = "Acme"
+            obj.jobs.append(job)
+        _id = obj.save()
+        obj = objects.Female.find_one({"_id":_id}, fields=["name", "jobs.title"])
+        with self.assertRaises(orm.NotLoadedException) as cm:
+            obj.jobs
+        objects.Female._fetch_missing = True
+        try:
+            obj = objects.Female.find_one({"_id":_id}, fields=["name", "jobs.title"])
+            self.assertEqual(obj.jobs[0].employer, "Acme")
+            del obj.jobs[0]
+            obj.save()
+        finally:
+            objects.Female._fetch_missing = False
+        jobs = objects.Female(id=_id).jobs
+        self.assertEqual([(j.title, j.employer) for j in jobs], [("Pilot", "Acme")])
+
     def test_update(self):
         obj = objects.Female(id=self.ids[0])
         obj.update({"$set":{"name":"Woop"}})
@@ -401,6 +613,253 @@ class Document(unittest.TestCase):
         del j["human_id"]
         self.assertEqual(j, self.person)
 
+    def test_lazy_fields(self):
+        self.job.locations.append(self.loc)
+        self.obj.jobs.append(self.job)
+        _id = self.obj.save()
+        obj = objects.LazyFemale(id=_id)
+        self.assertNotIn("jobs", obj.__dict__)
+        self.assertEqual(obj.name, "Anne")
+        self.assertIn("name", obj.__dict__)
+        self.assertNotIn("jobs", obj.__dict__)
+        j = obj._json()
+        del j["human_id"]
+        self.assertEqual(j, self.person)
+
+    def test_lazy_first_use(self):
+        #a model class used for the first time, before anything compiled it's schema
+        class LazyNote(orm.Document):
+            _db = "test"
+            _collection = "notes"
+            _lazy = True
+            title = field.Char()
+        note = LazyNote()
+        note.title = "a"
+        self.assertEqual(note.title, "a")
+        LazyNote.body = field.Char()
+        self.assertEqual(note.title, "a")
+        note.body = "b"
+        self.assertEqual(note._json(), {"title":"a", "body":"b"})
+
+    def test_dirty(self):
+        self.job.locations.append(self.loc)
+        self.obj.jobs.append(self.job)
+        _id = self.obj.save()
+        obj = self.obj.__class__(id=_id)
+        self.assertEqual(obj._save(), {})
+        obj.age = 28
+        self.assertEqual(obj._save(), {"age":28})
+        obj.save()
+        self.assertEqual(obj._save(), {})
+        self.assertEqual(self.obj.__class__(id=_id).age, 28)
+
+    def test_list_save(self):
+        self.obj.jobs.append(self.job)
+        _id = self.obj.save()
+        obj = self.obj.__class__(id=_id)
+        job = objects.Job()
+        job.title = "Manager"
+        obj.jobs.append(job)
+        self.assertEqual(obj._save()["jobs"].op, "$push")
+        obj.save()
+        obj.jobs[0].title = "Engineer"
+        self.assertEqual(obj._save(), {"jobs.0.title":u"Engineer"})
+        obj.save()
+        self.assertEqual([j.title for j in self.obj.__class__(id=_id).jobs], [u"Engineer", u"Manager"])
+        del obj.jobs[0]
+        self.assertEqual(len(obj._save()["jobs"]), 1)
+        obj.save()
+        self.assertEqual([j.title for j in self.obj.__class__(id=_id).jobs], [u"Manager"])
+        car = objects.Rodeo()
+        car.tires.extend([1, 2, 3])
+        car_id = car.save()
+        car = objects.Rodeo(id=car_id)
+        car.tires.remove(2)
+        self.assertEqual(car._save()["tires"].op, "$pull")
+        car.save()
+        self.assertEqual(list(objects.Rodeo(id=car_id).tires), [1, 3])
+        objects.Rodeo.__remove__()
+
+    def test_operators(self):
+        self.obj.age = 27
+        _id = self.obj.save()
+        obj = self.obj.__class__(id=_id)
+        obj.inc("age")
+        obj.inc("age", 2)
+        self.assertEqual(obj.age, 30)
+        self.assertEqual(obj._save()["age"].op, "$inc")
+        self.obj.__class__.__update__({"_id":_id}, {"$inc":{"age":10}})
+        obj.save()
+        self.assertEqual(self.obj.__class__(id=_id).age, 40)
+        obj = self.obj.__class__(id=_id)
+        obj.inc("age", 3)
+        obj.age = 43
+        self.assertEqual(obj._save(), {"age":43})
+        self.obj.__class__.__update__({"_id":_id}, {"$inc":{"age":10}})
+        obj.save()
+        self.assertEqual(self.obj.__class__(id=_id).age, 43)
+        partial = self.obj.__class__.find_one({"_id":_id}, fields=[])
+        partial.push("jobs", self.job)
+        self.assertEqual(partial._save()["jobs"].op, "$push")
+        partial.save()
+        self.assertEqual(len(self.obj.__class__(id=_id).jobs), 1)
+        car = objects.Rodeo()
+        car.tires.extend([1, 2])
+        car_id = car.save()
+        car = objects.Rodeo(id=car_id)
+        car.add_to_set("tires", 2, 3)
+        self.assertEqual(car._save()["tires"].value, {"$each":[3]})
+        car.save()
+        self.assertEqual(list(objects.Rodeo(id=car_id).tires), [1, 2, 3])
+        objects.Rodeo.__remove__()
+
+    def test_upsert(self):
+        obj = objects.BadHuman()
+        obj.name = "Anne"
+        obj.email = "anne@example.com"
+        _id = obj.save(upsert_on=["email"])
+        self.assertEqual(obj.human_id.__class__, int)
+        obj2 = objects.BadHuman()
+        obj2.name = "Beth"
+        obj2.email = "anne@example.com"
+        self.assertEqual(obj2.save(upsert_on=["email"]), _id)
+        self.assertEqual(obj2.human_id, obj.human_id)
+        self.assertEqual(obj2.created, obj.created)
+        self.assertEqual(objects.BadHuman.find({"em":"anne@example.com"}).count(), 1)
+        self.assertEqual(objects.BadHuman(id=_id).name, "Beth")
+        objects.BadHuman.__update__({"_id":_id}, {"$set":{"age":30}})
+        obj3 = objects.BadHuman()
+        obj3.name = "Cleo"
+        obj3.email = "anne@example.com"
+        obj3.save(upsert_on=["email"])
+        stored = objects.BadHuman(id=_id)
+        self.assertEqual(stored.name, "Cleo")
+        self.assertEqual(stored.age, 30)
+        objects.BadHuman.__remove__()
+
+    def test_versioned(self):
+        account = objects.Account()
+        account.owner = "Anne"
+        account.balance = 10
+        _id = account.save()
+        self.assertEqual(account.__version__, 1)
+        first = objects.Account(id=_id)
+        second = objects.Account(id=_id)
+        first.balance = 20
+        first.save()
+        self.assertEqual(first.__version__, 2)
+        first.save()
+        self.assertEqual(first.__version__, 2)
+        self.assertEqual(objects.Account(id=_id).__version__, 2)
+        second.balance = 30
+        self.assertRaises(orm.ConflictException, second.save)
+        self.assertEqual(objects.Account(id=_id).balance, 20)
+        partial = objects.Account.find_one({"_id":_id}, fields=["owner"])
+        self.assertEqual(partial.__version__, 2)
+        partial.owner = "Beth"
+        partial.save()
+        self.assertEqual(objects.Account(id=_id).__version__, 3)
+        objects.Account.__remove__()
+
+    def test_cache(self):
+        cache = objects.Author._cache
+        author = objects.Author()
+        author.name = "Anne"
+        _id = author.save()
+        misses = cache.misses
+        self.assertEqual(objects.Author(id=_id).name, "Anne")
+        self.assertEqual(cache.misses, misses + 1)
+        hits = cache.hits
+        self.assertEqual(objects.Author(id=_id).name, "Anne")
+        self.assertEqual(objects.Author.find_one({"_id":_id}).name, "Anne")
+        self.assertEqual(cache.hits, hits + 2)
+        author.name = "Beth"
+        author.save()
+        self.assertEqual(objects.Author(id=_id).name, "Beth")
+        objects.Author.__update__({"_id":_id}, {"$set":{"name":"Cleo"}})
+        self.assertEqual(objects.Author(id=_id).name, "Cleo")
+        for name in ["Dana", "Erin"]:
+            other = objects.Author()
+            other.name = name
+            objects.Author(id=other.save())
+        self.assertEqual(len(cache), 2)
+        objects.Author.__remove__()
+        self.assertIsNone(objects.Author.find_one({"_id":_id}))
+
+    def test_choices_cache(self):
+        choice = objects.BadHuman()._get("car")
+        render = lambda car: car._id
+        before = choice.get_choices(render=render)
+        car = objects.Car()
+        car.make = "Isuzu"
+        _id = car.save()
+        after = choice.get_choices(render=render)
+        self.assertEqual(len(after), len(before) + 1)
+        self.assertIn(_id, after)
+        objects.Car._connection().insert({"make":"Toyota"})
+        self.assertEqual(choice.get_choices(render=render), after)
+        choice.invalidate()
+        self.assertEqual(len(choice.get_choices(render=render)), len(after) + 1)
+        objects.Car._connection().insert({"make":"Honda"})
+        field.invalidate_choices()
+        self.assertEqual(len(choice.get_choices(render=render)), len(after) + 2)
+        objects.Car.__remove__()
+
+    def test_choices_copies(self):
+        objects.Car.__remove__()
+        objects.Car._connection().insert({"make":"Isuzu"})
+        choice = field.CollectionChoice(db=objects.Car._db, collection=objects.Car._collection, fields={"make":True})
+        def render(doc):
+            doc["make"] = "Lada"
+            return doc["make"]
+        choice.get_choices(render=render)
+        self.assertEqual(choice.get_choices(render=lambda doc: doc["make"]), ["Isuzu"])
+        objects.Car.__remove__()
+
+    def test_write_buffer(self):
+        ids = []
+        for i in xrange(25):
+            event = objects.Event()
+            event.message = "event %s" % i
+            ids.append(event.save())
+        self.assertEqual(len(set(ids)), 25)
+        objects.Event._buffer.flush()
+        self.assertEqual(objects.Event.find().count(), 25)
+        self.assertEqual(objects.Event(id=ids[0]).message, "event 0")
+        objects.Event.__remove__()
+        self.obj.save()
+        event = objects.Event()
+        event.source = self.obj
+        event.source.age = -1
+        with self.assertRaises(orm.DocumentException) as cm:
+            event.save()
+        self.assertEqual(event._id, None)
+        event.source.age = 30
+        _id = event.save()
+        objects.Event._buffer.flush()
+        self.assertEqual(objects.Event(id=_id)._id, _id)
+        self.assertEqual(objects.Event.find().count(), 1)
+        objects.Event.__remove__()
+
+    def test_write_concern(self):
+        self.assertEqual(self.obj._concern({"multi":True}), {"w":1, "multi":True})
+        self.assertEqual(self.obj._concern({"w":0}), {"w":0})
+        _id = self.obj.save(write_concern={"w":1, "wtimeout":1000})
+        self.assertEqual(self.obj.__class__(id=_id).name, "Anne")
+
+    def test_incremental_validation(self):
+        _id = self.obj.save()
+        self.obj.__class__.__update__({"_id":_id}, {"$set":{"age":-5}})
+        obj = self.obj.__class__(id=_id)
+        obj.height = 70
+        self.assertEqual(obj._errors(), {})
+        obj.save()
+        obj.name = None
+        with self.assertRaises(orm.DocumentException) as cm:
+            obj.save()
+        obj2 = objects.BadHuman._from_son({"_id":_id, "age":27})
+        self.assertIn("name", obj2._errors())
+
     def test_empty_relationship(self):
         _id = self.obj.save()
         obj2 = self.obj.__class__(id=_id)
@@ -425,6 +884,51 @@ class Document(unittest.TestCase):
                 job.title = "Engineer %s" % i
                 self.obj.jobs.append(job)
     
+    def test_schema(self):
+        names = [i[0] for i in objects.Female._schema()]
+        self.assertIn("cars", names)
+        self.assertIn("genitalia", names)
+        self.assertIn(u"em", objects.BadHuman.__keys__)
+        self.assertNotIn(u"cars", objects.BadHuman.__keys__)
+        obj = objects.Female()
+        self.assertIsNot(obj._get("name"), objects.Female.__dict__.get("name", objects.Human.__dict__["name"]))
+        self.assertIs(obj._get("name")._parent, obj)
+
+    def test_collection_change(self):
+        self.assertEqual(objects.Female._connection().name, "humans")
+        objects.Human._collection = "people"
+        try:
+            self.assertEqual(objects.Human._connection().name, "people")
+            self.assertEqual(objects.Female._connection().name, "people")
+        finally:
+            objects.Human._collection = "humans"
+        self.assertEqual(objects.Female._connection().name, "humans")
+
+    def test_json(self):
+        self.obj.name = "Anne"
+        self.obj.age = 27
+        job = objects.Job()
+        job.title = "Engineer"
+        self.obj.jobs.append(job)
+        obj = self.obj._json()
+        self.assertEqual(obj["name"], u"Anne")
+        self.assertEqual(obj["age"], 27)
+        self.assertEqual(obj["jobs"][0]["title"], u"Engineer")
+        self.assertNotIn("cars", obj)
+        self.assertIs(objects.Female._compiled("__json__"), objects.Female._compiled("__json__"))
+        bad = objects.BadHuman()
+        bad.email = "anne@example.com"
+        self.assertEqual(bad._json()["em"], u"anne@example.com")
+
+    def test_descriptor(self):
+        self.assertIsInstance(objects.Female.name, orm.Field)
+        self.assertIsInstance(objects.Female.jobs, orm.List)
+        self.assertIs(self.obj.jobs, self.obj._get("jobs"))
+        self.obj.name = "A"
+        self.assertEqual(self.obj._get("name")._error.__class__.__name__, "MinException")
+        self.obj.name = "Anne"
+        self.assertEqual(self.obj.name, "Anne")
+
     def test_bad_get(self):
         with self.assertRaises(AttributeError):
             self.obj._get("hoohaa")
@@ -513,6 +1017,34 @@ class Lazy(unittest.TestCase):
         
         self.assertEqual(self.car_ids, ids)
 
+    def test_lazy_query(self):
+        human = objects.Female(id=self.human_id)
+        query = {"make":"Toyota"}
+        self.assertEqual(human.cars(query=query).count(), 3)
+        self.assertEqual(query, {"make":"Toyota"})
+        self.assertEqual(human.cars.count(), 3)
+        self.assertTrue(human.cars.exists())
+        self.assertEqual(sorted(c._id for c in human.cars.all()), self.car_ids)
+
+    def test_lazy_prefetch(self):
+        other = objects.Female()
+        other.name = "Beth"
+        other_id = other.save()
+        car = objects.Car()
+        car.owner = other_id
+        car_id = car.save()
+        nobody = objects.Female()
+        nobody.name = "Cleo"
+        nobody.save()
+        humans = [objects.Female(id=self.human_id), objects.Female(id=other_id), nobody]
+        objects.Human.cars.prefetch(humans)
+        self.assertEqual(sorted(c._id for c in humans[0].cars.all()), self.car_ids)
+        self.assertEqual([c._id for c in humans[1].cars.all()], [car_id])
+        self.assertEqual(humans[2].cars.all(), [])
+        self.assertFalse(humans[2].cars.exists())
+        humans = list(objects.Female.find({"_id":{"$in":[self.human_id, other_id]}}).prefetch("cars"))
+        self.assertEqual(sorted(h.cars.count() for h in humans), [1, 3])
+
     def tearDown(self):
         self.obj.__class__.__remove__()
         objects.Car.__remove__()